@@ -1,9 +1,69 @@
 #!/usr/bin/env python
 
-from whip.xmlsplitter import split_xml, parse_args
+import os
+import sys
+
+from whip.xmlsplitter import (
+    split_xml,
+    split_xml_streaming,
+    choose_numfiles,
+    imbalance,
+    optimise_splits,
+    split_filename,
+    parse_args
+)
+from whip.beagleoptimiser import pretty_time, option_to_kwargs
+from whip.cache import EstimateCache, SplitCache
 
 def main(args):
-    split_xml( args.xmlfile, args.numfiles )
+    if args.compress and args.optimise:
+        sys.exit( '--optimise cannot be used with --compress as beast only ' \
+            'reads plain xml' )
+
+    if args.budget is not None:
+        with open(os.devnull, 'w') as devnull:
+            args.numfiles, predicted = choose_numfiles(
+                args.xmlfile, args.budget, stream=devnull, balance=args.balance,
+                **option_to_kwargs(args.beagle_options)
+            )
+        print "Splitting into {0} files to fit a budget of {1}".format(
+            args.numfiles, pretty_time(args.budget))
+        for i, hours in enumerate(predicted, start=1):
+            print "split_{0}.xml predicted runtime: {1}".format(i, pretty_time(hours))
+
+    sitepatterns = None
+    if args.stream:
+        costs = split_xml_streaming(
+            args.xmlfile, args.numfiles, args.balance, args.compress
+        )
+    else:
+        cache = SplitCache() if args.usecache else None
+        costs = split_xml(
+            args.xmlfile, args.numfiles, args.jobs, args.balance, args.patterns,
+            cache, args.compress
+        )
+        if args.patterns:
+            costs, sitepatterns = costs
+    for i, cost in enumerate(costs, start=1):
+        splitfile = split_filename(i, args.compress)
+        print "{0} predicted cost: {1}".format(splitfile, cost)
+        if sitepatterns is not None:
+            print "{0} site patterns: {1}".format(splitfile, sitepatterns[i-1])
+    print "Predicted imbalance: {0:.2%}".format(imbalance(costs))
+
+    if args.optimise:
+        splitfiles = [
+            'split_{0}.xml'.format(i) for i in range(1, len(costs)+1)
+        ]
+        with open(os.devnull, 'w') as devnull:
+            best, scripts = optimise_splits(
+                splitfiles, costs, devnull, jobs=args.jobs,
+                cache=EstimateCache()
+            )
+        print "Fastest options: {0} estimated to take {1} per split".format(
+            best[0], pretty_time(best[1]))
+        for script in scripts:
+            print "Wrote {0}".format(script)
 
 if __name__ == '__main__':
     main(parse_args())
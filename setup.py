@@ -11,6 +11,7 @@ setup(
     scripts = glob('bin/*'),
     install_requires = [
         'lxml',
+        'numpy',
         'argparse', # For python 2.6 compatibility
     ]
 )
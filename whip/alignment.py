@@ -0,0 +1,227 @@
+'''
+numpy helpers for working with alignments as byte matrices
+'''
+
+import os
+from os.path import join, exists
+import re
+
+import numpy as np
+
+# Characters in a sequence that do not count towards its cost
+GAP_CHARS = '-?'
+
+def sequence_residues( sequence ):
+    '''
+    Get the alignment characters of a <sequence> element with all
+    whitespace removed
+    '''
+    return re.sub(r'\s+', '', ''.join(sequence.itertext()))
+
+def column_patterns( matrix ):
+    '''
+    Find the unique columns(site patterns) of an AlignmentStore.rows matrix
+
+    Every column is viewed as a single opaque value so numpy can sort and
+    compare whole columns at once
+
+    Returns (pattern of each column, how many columns have each pattern)
+    '''
+    numseqs, numsites = matrix.shape
+    if numseqs == 0 or numsites == 0:
+        return np.zeros( numsites, dtype=np.intp ), np.zeros( 0, dtype=np.intp )
+    columns = np.ascontiguousarray( matrix.T )
+    keys = columns.view( np.dtype((np.void, numseqs)) ).ravel()
+    unique, inverse, counts = np.unique(
+        keys, return_inverse=True, return_counts=True
+    )
+    return inverse, counts
+
+def count_patterns( matrix ):
+    '''
+    Number of unique columns in an AlignmentStore.rows matrix
+    '''
+    return len( column_patterns( matrix )[1] )
+
+# Most cells compared at once by hamming_distances and AlignmentStore.costs
+HAMMING_BLOCK_CELLS = 16 * 1024 * 1024
+
+def row_blocks( matrix ):
+    '''
+    Yield (start, rows) for consecutive blocks of matrix rows holding at
+    most HAMMING_BLOCK_CELLS cells(always at least one row)
+    '''
+    numseqs, numsites = matrix.shape
+    block = max( 1, HAMMING_BLOCK_CELLS // max(1, numsites) )
+    for start in range( 0, numseqs, block ):
+        yield start, matrix[start:start+block]
+
+def hamming_distances( matrix, row ):
+    '''
+    Number of columns every row of matrix differs from matrix[row] at
+
+    Rows are compared a block at a time so only a block's worth of
+    comparisons is ever held in memory
+    '''
+    target = np.array( matrix[row] )
+    distances = np.empty( matrix.shape[0], dtype=np.intp )
+    for start, rows in row_blocks( matrix ):
+        distances[start:start+len(rows)] = ( rows != target ).sum( axis=1 )
+    return distances
+
+def similarity_split( matrix, numchunks ):
+    '''
+    Group the rows of an AlignmentStore.rows matrix into numchunks chunks of similar
+    sequences so each chunk has fewer unique site patterns
+
+    Seeds are picked farthest first(each is the row furthest by hamming
+    distance from the seeds so far) and then rows are handed to their
+    nearest seed that still has room. Rows with the most to lose from not
+    getting their nearest seed go first. There are always numchunks
+    chunks(or one per row if there are fewer rows) and their sizes differ
+    by at most one row. evenly_split_iterable can make fewer, larger pieces
+
+    Returns the row indexes of each chunk
+    '''
+    numseqs = matrix.shape[0]
+    numchunks = min( numchunks, numseqs )
+    if numchunks < 1:
+        return []
+    seeds = [0]
+    distances = [hamming_distances( matrix, 0 )]
+    nearest = distances[0].copy()
+    while len(seeds) < numchunks:
+        seed = int( np.argmax( nearest ) )
+        if nearest[seed] == 0:
+            # Everything left is identical to a seed so any row will do
+            seed = [i for i in range(numseqs) if i not in seeds][0]
+        seeds.append( seed )
+        distances.append( hamming_distances( matrix, seed ) )
+        nearest = np.minimum( nearest, distances[-1] )
+    distances = np.array( distances )
+
+    room = [numseqs // numchunks] * numchunks
+    for i in range( numseqs % numchunks ):
+        room[i] += 1
+    chunks = [[] for seed in seeds]
+    for i, seed in enumerate( seeds ):
+        chunks[i].append( seed )
+        room[i] -= 1
+    ranked = np.sort( distances, axis=0 )
+    if numchunks > 1:
+        regret = ranked[1] - ranked[0]
+    else:
+        regret = np.zeros( numseqs, dtype=np.intp )
+    seeded = set( seeds )
+    # Stable so ties keep alignment order
+    for row in np.argsort( -regret, kind='mergesort' ):
+        if row in seeded:
+            continue
+        for chunk in np.argsort( distances[:, row], kind='mergesort' ):
+            if room[chunk] > 0:
+                chunks[chunk].append( int(row) )
+                room[chunk] -= 1
+                break
+    return [sorted(chunk) for chunk in chunks]
+
+class AlignmentStore(object):
+    '''
+    The taxon ids and residues of an alignment held as numpy arrays so it
+    can be split, counted and costed without walking the xml again
+
+    ids - Array of the taxon id of every sequence
+    matrix - 2-D uint8 array with a row of character codes per sequence.
+        Rows are padded with - up to the longest sequence
+    lengths - How many residues each row had before padding
+    '''
+    def __init__( self, ids, matrix, lengths ):
+        self.ids = ids
+        self.matrix = matrix
+        self.lengths = lengths
+
+    @classmethod
+    def from_residues( cls, ids, residues ):
+        '''
+        Build a store from taxon ids and their residue strings
+        '''
+        lengths = np.array( [len(r) for r in residues], dtype=np.intp )
+        width = max( lengths ) if len(residues) else 0
+        data = ''.join( str(r).ljust(width, '-') for r in residues )
+        matrix = np.frombuffer( data, dtype=np.uint8 )
+        return cls(
+            np.array( ids ), matrix.reshape( len(residues), width ), lengths
+        )
+
+    @classmethod
+    def from_sequences( cls, sequences ):
+        '''
+        Build a store from <alignment><sequence> elements
+        Ids come from each sequence's <taxon idref="...">
+        '''
+        ids = []
+        residues = []
+        for sequence in sequences:
+            taxon = sequence.find( 'taxon' )
+            ids.append( taxon.get('idref', '') if taxon is not None else '' )
+            residues.append( sequence_residues(sequence) )
+        return cls.from_residues( ids, residues )
+
+    def __len__( self ):
+        return len(self.ids)
+
+    def rows( self, rows=None ):
+        '''
+        The matrix of rows(default every row) cut to the columns every one
+        of them has
+        '''
+        if rows is None:
+            rows = slice( None )
+        lengths = self.lengths[rows]
+        width = lengths.min() if len(lengths) else 0
+        return self.matrix[rows, :width]
+
+    def costs( self ):
+        '''
+        Array of the ungapped residue count of every row
+
+        Counted a block of rows at a time so a memory mapped matrix is
+        never compared all at once
+        '''
+        gaps = np.zeros( len(self), dtype=np.intp )
+        for start, rows in row_blocks( self.matrix ):
+            for c in GAP_CHARS:
+                gaps[start:start+len(rows)] += ( rows == ord(c) ).sum( axis=1 )
+        # Padding is made of - so only gaps within each row are left
+        padding = self.matrix.shape[1] - self.lengths
+        return self.lengths - ( gaps - padding )
+
+    def site_patterns( self, rows=None ):
+        '''
+        Number of site patterns across rows(default every row)
+        '''
+        return count_patterns( self.rows(rows) )
+
+    def save( self, path ):
+        '''
+        Save the store into the directory path as .npy files
+        '''
+        if not exists( path ):
+            os.makedirs( path )
+        np.save( join(path, 'ids.npy'), self.ids )
+        np.save( join(path, 'matrix.npy'), self.matrix )
+        np.save( join(path, 'lengths.npy'), self.lengths )
+
+    @classmethod
+    def load( cls, path, mmap=True ):
+        '''
+        Load a store saved in the directory path
+
+        mmap - Memory map the matrix read only instead of reading it in so
+            only the pages that are used get read
+        '''
+        mode = 'r' if mmap else None
+        return cls(
+            np.load( join(path, 'ids.npy') ),
+            np.load( join(path, 'matrix.npy'), mmap_mode=mode ),
+            np.load( join(path, 'lengths.npy') )
+        )
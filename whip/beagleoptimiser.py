@@ -3,17 +3,256 @@ import re
 import tempfile
 import os
 import shutil
-from os.path import abspath
+from os.path import abspath, join, dirname, realpath, isdir
+from distutils.spawn import find_executable
+import glob
+import math
+import json
+import csv
+import socket
 import itertools
 from datetime import datetime, timedelta
 import multiprocessing
 import sys
 import time
+import threading
+import Queue
+import signal
+from collections import namedtuple
+
+from lxml import etree
+
+from whip.cache import estimate_key, host_fingerprint, beast_version, file_hash
 
 # Exception for invalid Beast xml
 class InvalidBeastXmlError(Exception): pass
 
-def run_beast_options( xmlfile, stream=sys.stdout, excludelist=[] ):
+class BeastTimeoutError(ValueError):
+    '''
+    Raised when beast runs longer than its timeout without giving what
+    was needed
+    '''
+    def __init__( self, elapsed ):
+        super(BeastTimeoutError,self).__init__(
+            'Beast timed out after {0:.1f} seconds'.format(elapsed)
+        )
+        self.elapsed = elapsed
+
+class BeastProcess(object):
+    '''
+    A running beast command whose stdout and stderr are each drained by
+    their own thread so neither pipe can fill up and block beast
+
+    timeout - Seconds after starting that lines() gives up, kills beast and
+        raises BeastTimeoutError
+    '''
+    def __init__( self, cmd, cwd, timeout=None ):
+        self.timeout = timeout
+        self.start = None
+        if timeout is not None:
+            self.start = time.time()
+        # beast is a wrapper script around java so it is started in its own
+        #  process group to be able to kill java along with it
+        self.process = Popen(
+            cmd, stdout=PIPE, stderr=PIPE, cwd=cwd, preexec_fn=os.setsid
+        )
+        self.stdout = Queue.Queue()
+        self.stderr = []
+        self.readers = [
+            threading.Thread( target=self._read_stdout ),
+            threading.Thread( target=self._read_stderr ),
+        ]
+        for reader in self.readers:
+            reader.daemon = True
+            reader.start()
+
+    # readline instead of iterating the pipes as file iteration reads ahead
+    #  and holds back lines until a whole buffer has arrived
+    def _read_stdout( self ):
+        for line in iter(self.process.stdout.readline, ''):
+            self.stdout.put( line )
+        # Signal the end of output
+        self.stdout.put( None )
+
+    def _read_stderr( self ):
+        for line in iter(self.process.stderr.readline, ''):
+            self.stderr.append( line )
+
+    def elapsed( self ):
+        '''
+        Seconds since beast was started(only tracked with a timeout)
+        '''
+        return time.time() - self.start
+
+    def lines( self ):
+        '''
+        Yield beast stdout lines as they arrive until beast exits
+        '''
+        while True:
+            # Poll at least every second so KeyboardInterrupt is noticed
+            wait = 1
+            if self.timeout is not None:
+                wait = min( wait, self.timeout - self.elapsed() )
+                if wait <= 0:
+                    self.kill()
+                    raise BeastTimeoutError( self.elapsed() )
+            try:
+                line = self.stdout.get( timeout=wait )
+            except Queue.Empty:
+                continue
+            if line is None:
+                return
+            yield line
+
+    def error_output( self ):
+        '''
+        Everything beast has written to stderr
+        '''
+        return ''.join(self.stderr)
+
+    def wait( self ):
+        '''
+        Wait for beast to exit and its output to be read
+        Returns the exit code
+        '''
+        self.process.wait()
+        for reader in self.readers:
+            reader.join( 5 )
+        return self.process.returncode
+
+    def kill( self ):
+        '''
+        Kill beast and everything it started if still running and reap it
+        '''
+        if self.process.poll() is not None:
+            # Already reaped so its pid could belong to another process now
+            self.wait()
+            return
+        for kill in (self._killpg, self.process.kill):
+            try:
+                kill()
+            except OSError as e:
+                # Already gone
+                pass
+        self.wait()
+
+    def _killpg( self ):
+        os.killpg( self.process.pid, signal.SIGKILL )
+
+class BeastSupervisor(object):
+    '''
+    Launches BeastProcesses and keeps track of the running ones so many
+    concurrent probes can all be cancelled at once
+    '''
+    def __init__( self ):
+        self.running = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def launch( self, cmd, cwd, timeout=None ):
+        '''
+        Start cmd in cwd as a BeastProcess
+        Raises ValueError if the supervisor was already cancelled
+        '''
+        with self.lock:
+            if self.cancelled:
+                raise ValueError( 'Beast supervisor was cancelled' )
+            process = BeastProcess( cmd, cwd, timeout )
+            self.running.add( process )
+        return process
+
+    def finished( self, process ):
+        '''
+        Stop tracking a process that is done
+        '''
+        with self.lock:
+            self.running.discard( process )
+
+    def cancel( self ):
+        '''
+        Kill every running process and refuse to launch any more
+        '''
+        with self.lock:
+            self.cancelled = True
+            running = list(self.running)
+        for process in running:
+            process.kill()
+
+# Columns written by write_runs_csv and keys written by write_runs_json
+RUN_FIELDS = (
+    'xmlfile', 'option', 'status', 'hours', 'samples', 'elapsed', 'host',
+    'fingerprint', 'beast_version', 'task'
+)
+
+class BeastRun(tuple):
+    '''
+    (options run, estimated hours) for one option from run_beast_options
+    along with how the run went
+
+    status - ok, cached, error(beast gave no estimate) or timeout
+    elapsed - Seconds spent getting the estimate
+    samples - hours/million states readings the estimate came from
+    xmlfile - The xml that was run
+    host - Host name it was run on
+    fingerprint - whip.cache.host_fingerprint of the host
+    beast_version - BEAST version that was run
+    task - Id of the xml in a beagle_sweep queue(see whip.sweep) as xmlfile
+        is only its original file name there
+    '''
+    def __new__( cls, option, hours, status='ok', elapsed=None, samples=None,
+            xmlfile=None, host=None, fingerprint=None, beast_version=None,
+            task=None ):
+        run = tuple.__new__( cls, (option, hours) )
+        run.status = status
+        run.elapsed = elapsed
+        run.samples = samples
+        run.xmlfile = xmlfile
+        run.host = host
+        run.fingerprint = fingerprint
+        run.beast_version = beast_version
+        run.task = task
+        return run
+
+    @property
+    def option( self ):
+        return self[0]
+
+    @property
+    def hours( self ):
+        return self[1]
+
+    def as_dict( self ):
+        '''
+        Dictionary of the RUN_FIELDS with no hours for failed runs
+        '''
+        d = dict( (field, getattr(self, field)) for field in RUN_FIELDS )
+        if d['hours'] == sys.maxint:
+            d['hours'] = None
+        return d
+
+def write_runs_json( runs, fh ):
+    '''
+    Write BeastRuns to fh as a JSON list of BeastRun.as_dict
+    '''
+    json.dump( [run.as_dict() for run in runs], fh, indent=2 )
+    fh.write( '\n' )
+
+def write_runs_csv( runs, fh ):
+    '''
+    Write BeastRuns to fh as csv with a header of RUN_FIELDS
+    samples are separated by ;
+    '''
+    writer = csv.DictWriter( fh, RUN_FIELDS )
+    writer.writeheader()
+    for run in runs:
+        row = run.as_dict()
+        if row['samples'] is not None:
+            row['samples'] = ';'.join( str(s) for s in row['samples'] )
+        writer.writerow( row )
+
+def run_beast_options( xmlfile, stream=sys.stdout, excludelist=[], jobs=1,
+        cache=None, refresh=False, samples=None, strategy='all', probe=False,
+        timeout=None, beagle_info=None, smart=False, threads=False ):
     '''
     Runs beast with a combination of available -beagle_options
     Focuses only on the following options:
@@ -25,47 +264,588 @@ def run_beast_options( xmlfile, stream=sys.stdout, excludelist=[] ):
     -beagle_order at this point is left out due to the increase in run time that
     would occur due to the extra permutations
 
-    Returns a list of tuples (options run, estimated hours, time to generate in seconds) sorted by estimated hours
-        ascending
+    jobs - How many options to estimate at the same time. See schedule_options
+        for how options are kept from competing for the same cpus/gpu
+    cache - whip.cache.EstimateCache to reuse estimates of this xml on this
+        host from. Successful estimates are stored in it
+    refresh - Ignore existing cache entries but still store new estimates
+    samples - Estimate each option from this many hours/million readings with
+        sample_beast_runtime instead of only the first one. Sampling of an
+        option stops early once it is clearly slower than the best option
+        found so far
+    strategy - all estimates every option once. halving runs every option
+        briefly and then keeps rerunning only the faster half with twice the
+        samples(see successive_halving). model only runs a few
+        -beagle_instances counts for each backend and the counts near the
+        optimum of a scaling curve fitted to them(see model_search)
+    probe - Time each option on a build_probe_xml copy of xmlfile that has a
+        short chain and writes no log files
+    timeout - Seconds to give each option before beast is killed and the
+        option is recorded as timed out
+    beagle_info - Output of get_beagle_info if it was already run
+    smart/threads - See get_available_beagle_options. The smart instance
+        counts are limited by the site patterns in xmlfile
+
+    Returns a list of BeastRun (options run, estimated hours) sorted by
+        estimated hours ascending. Options that failed or timed out have
+        sys.maxint hours
+    '''
+    if beagle_info is None and cache is not None:
+        beagle_info = get_beagle_info()
+    options = xml_options( xmlfile, beagle_info, excludelist, smart, threads )
+    # Every beast run goes through this so an error or interrupt in one
+    #  option kills the beasts still running for the others
+    supervisor = BeastSupervisor()
+    run_option = option_runner(
+        xmlfile, stream, cache, refresh, samples, probe, timeout, beagle_info,
+        supervisor
+    )
+    try:
+        if strategy == 'halving':
+            return successive_halving(
+                options, run_option, jobs=jobs, samples=samples or 1,
+                stream=stream
+            )
+        if strategy == 'model':
+            return model_search( options, run_option, jobs=jobs, stream=stream )
+        runs = schedule_options( options, run_option, jobs=jobs )
+    except BaseException:
+        supervisor.cancel()
+        raise
+    runs.sort( key=lambda x: x[1] )
+    return runs
+
+def run_beast_batch( xmlfiles, stream=sys.stdout, excludelist=[], jobs=1,
+        cache=None, refresh=False, samples=None, probe=False, timeout=None,
+        beagle_info=None, smart=False, threads=False ):
+    '''
+    run_beast_options for many xml files at once
+
+    The beagle resources are only detected once and the options of every
+    file go through a single schedule_options pool, so with enough jobs the
+    whole batch takes about as long as the slowest files instead of the sum
+    of all of them. See run_beast_options for the arguments
+
+    Returns the BeastRuns of every file in xmlfiles order, each file's runs
+    sorted by estimated hours ascending
+    '''
+    if beagle_info is None:
+        beagle_info = get_beagle_info()
+    supervisor = BeastSupervisor()
+    tasks = []
+    runners = {}
+    for xmlfile in xmlfiles:
+        options = xml_options( xmlfile, beagle_info, excludelist, smart, threads )
+        tasks += [(xmlfile, option) for option in options]
+        runners[xmlfile] = option_runner(
+            xmlfile, stream, cache, refresh, samples, probe, timeout,
+            beagle_info, supervisor
+        )
+    try:
+        results = schedule_options(
+            tasks, lambda task: runners[task[0]]( task[1] ), jobs=jobs,
+            resources=lambda task: option_resources( task[1] )
+        )
+    except BaseException:
+        supervisor.cancel()
+        raise
+    runs = []
+    for xmlfile in xmlfiles:
+        xmlruns = [
+            run for (x, option), run in zip(tasks, results) if x == xmlfile
+        ]
+        runs += sorted( xmlruns, key=lambda x: x[1] )
+    return runs
+
+def write_ranking( runs, stream=sys.stdout ):
+    '''
+    Write the options of every xml in runs ranked by estimated hours and
+    then the best option of each xml to stream
+    '''
+    byxml = []
+    for run in runs:
+        if not byxml or byxml[-1][0] != run.xmlfile:
+            byxml.append( (run.xmlfile, []) )
+        byxml[-1][1].append( run )
+    stream.write( 'Results sorted by estimated runtime:\n' )
+    for xmlfile, xmlruns in byxml:
+        stream.write( '{0}\n'.format(xmlfile) )
+        for run in sorted( xmlruns, key=lambda x: x[1] ):
+            if run.status == 'timeout':
+                stream.write( '\t{0} timed out after {1}\n'.format(
+                    run.option, pretty_time(run.elapsed / 3600.0)) )
+            elif run.status == 'error':
+                stream.write( '\t{0} failed\n'.format(run.option) )
+            else:
+                stream.write( '\t{0} estimated to take {1}\n'.format(
+                    run.option, pretty_time(run.hours)) )
+    if len(byxml) > 1:
+        stream.write( 'Best option for each xml:\n' )
+        for xmlfile, xmlruns in byxml:
+            best = min( xmlruns, key=lambda x: x[1] )
+            if best.hours == sys.maxint:
+                stream.write( '\t{0}: no estimates\n'.format(xmlfile) )
+            else:
+                stream.write( '\t{0}: {1} {2}\n'.format(
+                    xmlfile, best.option, pretty_time(best.hours)) )
+
+def xml_options( xmlfile, beagle_info=None, excludelist=[], smart=False,
+        threads=False ):
+    '''
+    The get_available_beagle_options to run for xmlfile without the ones
+    that contain anything in excludelist
+
+    Raises InvalidBeastXmlError if xmlfile has no screenLog to read the
+    estimates from
     '''
     with open(xmlfile) as fh:
         if 'screenLog' not in fh.read():
             raise InvalidBeastXmlError(
                 '{0} does not contain a screenLog definition'.format(xmlfile)
             )
-    options = get_available_beagle_options()
-    runs = []
-    for option in options:
+    patterns = None
+    if smart:
+        # xmlsplitter imports this module
+        from whip.xmlsplitter import xml_site_patterns
+        patterns = xml_site_patterns( xmlfile )
+    options = []
+    avail = get_available_beagle_options( beagle_info, smart, patterns, threads )
+    for option in avail:
         # Skip the exluded options
         skip=False
         for exclude in excludelist:
             if exclude in option:
                 skip=True
                 break
-        if skip:
-            continue
-        beast_options = {}
-        for o in option.split(' ', 1):
-            beast_options[o] = True
+        if not skip:
+            options.append( option )
+    return options
+
+def option_runner( xmlfile, stream=sys.stdout, cache=None, refresh=False,
+        samples=None, probe=False, timeout=None, beagle_info=None,
+        supervisor=None ):
+    '''
+    Build the run(option) function that run_beast_options calls for every
+    option of xmlfile. It returns a BeastRun for the option
+    See run_beast_options for the arguments
+
+    run(option, samples) can also be given how many samples to take, as
+    successive_halving does. A cached estimate is only used if it has at
+    least that many readings, so later halving rounds still get longer runs
+    '''
+    # Upper confidence bound of the best sampled estimate so far
+    leader = {'upper': None}
+    leaderlock = threading.Lock()
+    # Recorded with every run
+    runinfo = {
+        'xmlfile': abspath(xmlfile), 'host': socket.gethostname(),
+    }
+    if beagle_info is not None:
+        runinfo['fingerprint'] = host_fingerprint( beagle_info )
+        runinfo['beast_version'] = beast_version( beagle_info )
+    chainlength = get_chainlength( xmlfile )
+    # Probe estimates are cached apart from estimates of the whole xml
+    mode = None
+    if probe:
+        mode = 'probe logevery={0} rows={1}'.format(PROBE_LOGEVERY, PROBE_ROWS)
+    # Hashed once here instead of for every option's cache key
+    if cache is not None:
+        xmlhash = file_hash( xmlfile )
+
+    def run_option( option, samples=samples ):
+        if cache is not None:
+            key = estimate_key( xmlhash, beagle_info, option, mode )
+            cached = cache.get( key )
+            # Estimates from fewer readings than asked for are rerun
+            if cached is not None and not refresh and \
+                    len(cached.get('samples') or []) >= (samples or 0):
+                msg = '{0} estimate: {1} (Cached)'.format(
+                    option, pretty_time(cached['hours']))
+                stream.write( msg + '\n' )
+                print msg
+                return BeastRun(
+                    option, cached['hours'], 'cached', cached.get('elapsed'),
+                    cached.get('samples'), **runinfo
+                )
+        beast_options = option_to_kwargs( option )
         print "Running beast with {0}".format(option)
         start = time.time()
+        estimate = None
+        status = 'ok'
+        readings = None
         try:
-            esthours = estimate_beast_runtime(
-                xmlfile, seed=999, stream=stream, **beast_options
-            )
+            if samples:
+                with leaderlock:
+                    stop_above = leader['upper']
+                estimate = sample_beast_runtime(
+                    xmlfile, seed=999, stream=stream, samples=samples,
+                    stop_above=stop_above, probe=probe, timeout=timeout,
+                    supervisor=supervisor, **beast_options
+                )
+                esthours = estimate.hours
+                readings = estimate.samples
+                with leaderlock:
+                    if leader['upper'] is None or estimate.upper < leader['upper']:
+                        leader['upper'] = estimate.upper
+            else:
+                esthours = estimate_beast_runtime(
+                    xmlfile, seed=999, stream=stream, probe=probe,
+                    timeout=timeout, supervisor=supervisor, **beast_options
+                )
+                if chainlength:
+                    readings = [esthours * 1000000.0 / chainlength]
+        except BeastTimeoutError as e:
+            esthours = sys.maxint
+            status = 'timeout'
         except ValueError as e:
             # Just set estimated hours really high to indicate an error
             esthours = sys.maxint
-        diff = (time.time() - start) / 3600.0
+            status = 'error'
+        elapsed = time.time() - start
+        diff = elapsed / 3600.0
         msg = '{0} estimate: {1} (Time to generate: {2})'.format(
             option, pretty_time(esthours), pretty_time(diff))
+        if status == 'timeout':
+            msg = '{0} timed out after {1}'.format(option, pretty_time(diff))
+        elif estimate is not None:
+            msg = '{0} estimate: {1} (95% CI {2} - {3} from {4} samples) ' \
+                '(Time to generate: {5})'.format(
+                option, pretty_time(esthours), pretty_time(estimate.lower),
+                pretty_time(estimate.upper), len(estimate.samples),
+                pretty_time(diff))
         stream.write( msg + '\n' )
         print msg
-        runs.append( (option, esthours) )
-    runs.sort( key=lambda x: x[1] )
-    return runs
+        if cache is not None and esthours != sys.maxint:
+            cache.put(
+                key, esthours, option=option, xmlfile=abspath(xmlfile),
+                samples=readings, elapsed=elapsed
+            )
+        return BeastRun(
+            option, esthours, status, elapsed, readings, **runinfo
+        )
+    return run_option
+
+def successive_halving( options, run, jobs=1, samples=1, stream=sys.stdout ):
+    '''
+    Find the fastest option without giving every option a long run
+
+    Every round runs the remaining options with run(option, nsamples) which
+    returns an (option, hours) tuple, then drops the slower half. Each round
+    doubles nsamples starting from samples, so the survivors get longer and
+    more reliable runs while the total time grows with the log of the number
+    of options instead of linearly
+
+    Returns the (option, hours) tuples of the final round sorted by hours
+    followed by the eliminated options, latest eliminated first, with the
+    hours from the round they were dropped in
+    '''
+    eliminated = []
+    rnd = 0
+    while True:
+        nsamples = samples * 2 ** rnd
+        msg = 'Round {0}: {1} options with {2} samples each'.format(
+            rnd + 1, len(options), nsamples)
+        stream.write( msg + '\n' )
+        print msg
+        results = schedule_options(
+            options, lambda option: run(option, nsamples), jobs=jobs
+        )
+        results.sort( key=lambda x: x[1] )
+        keep = max(1, len(results) / 2)
+        eliminated = results[keep:] + eliminated
+        results = results[:keep]
+        if keep == 1:
+            return results + eliminated
+        options = [option for option, hours in results]
+        rnd += 1
+
+def split_instances( option ):
+    '''
+    Split an option into the option without -beagle_instances(its backend)
+    and the -beagle_instances count(1 without it)
+    '''
+    m = re.search( ' -beagle_instances (\d+)', option )
+    if not m:
+        return option, 1
+    return option[:m.start()] + option[m.end():], int(m.group(1))
+
+def fit_scaling_curve( points ):
+    '''
+    Least squares fit of T(n) = a + b/n + c*n to (instances, hours) points
+
+    a is the part that does not parallelise, b/n the part that divides over
+    the instances and c*n the overhead each extra instance adds
+
+    Returns (a, b, c)
+    Raises ValueError with fewer than 3 different instance counts
+    '''
+    if len(set(n for n, hours in points)) < 3:
+        raise ValueError( 'Need at least 3 different instance counts' )
+    # Normal equations of the basis 1, 1/n, n
+    rows = [[1.0, 1.0/n, float(n)] for n, hours in points]
+    ata = [[sum(r[i]*r[j] for r in rows) for j in range(3)] for i in range(3)]
+    aty = [sum(r[i]*hours for r, (n, hours) in zip(rows, points)) for i in range(3)]
+    # Gaussian elimination with partial pivoting
+    m = [ata[i] + [aty[i]] for i in range(3)]
+    for col in range(3):
+        pivot = max(range(col, 3), key=lambda row: abs(m[row][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if m[col][col] == 0:
+            raise ValueError( 'Instance counts do not determine the curve' )
+        for row in range(col+1, 3):
+            f = m[row][col] / m[col][col]
+            m[row] = [x - f*y for x, y in zip(m[row], m[col])]
+    coef = [0.0] * 3
+    for row in (2, 1, 0):
+        rest = sum(m[row][j] * coef[j] for j in range(row+1, 3))
+        coef[row] = (m[row][3] - rest) / m[row][row]
+    return tuple(coef)
+
+def predict_best_instances( fit, counts ):
+    '''
+    The count in counts with the lowest predicted hours from a
+    fit_scaling_curve fit
+    The continuous optimum is at sqrt(b/c) when b and c are positive
+    '''
+    a, b, c = fit
+    return min( counts, key=lambda n: a + b/float(n) + c*n )
+
+def model_search( options, run, jobs=1, stream=sys.stdout, refine=1 ):
+    '''
+    Find the best -beagle_instances count of each backend without running
+    every count
+
+    Options are grouped by split_instances. Groups with more than 4 counts
+    only run their smallest, largest and middle(geometric) count first.
+    A fit_scaling_curve fit of those picks the count predicted to be
+    fastest, which is run along with refine counts on either side of it
+    Every other count of the group is never run
+
+    run is called with each option and returns an (option, hours) tuple
+
+    Returns the (option, hours) tuples of the options that were run sorted
+    by hours
+    '''
+    groups = {}
+    for option in options:
+        backend, n = split_instances( option )
+        groups.setdefault( backend, {} )[n] = option
+    first = []
+    for backend, bycount in groups.items():
+        counts = sorted(bycount)
+        if len(counts) > 4:
+            lo, hi = counts[0], counts[-1]
+            middle = math.sqrt( lo * hi )
+            mid = min( counts[1:-1], key=lambda n: abs(math.log(n / middle)) )
+            counts = [lo, mid, hi]
+        first += [bycount[n] for n in counts]
+    results = schedule_options( first, run, jobs=jobs )
+    measured = dict( (option, hours) for option, hours in results )
+
+    second = []
+    for backend, bycount in groups.items():
+        counts = sorted(bycount)
+        points = [
+            (n, measured[bycount[n]]) for n in counts
+            if bycount[n] in measured and measured[bycount[n]] != sys.maxint
+        ]
+        # Small groups were run completely
+        if all(bycount[n] in measured for n in counts):
+            continue
+        try:
+            fit = fit_scaling_curve( points )
+        except ValueError as e:
+            continue
+        best = predict_best_instances( fit, counts )
+        msg = '{0}: T(n) = {1} + {2}/n + {3}*n hours, best near ' \
+            '-beagle_instances {4}'.format(
+            backend, fit[0], fit[1], fit[2], best)
+        stream.write( msg + '\n' )
+        print msg
+        i = counts.index( best )
+        for n in counts[max(0, i-refine):i+refine+1]:
+            if bycount[n] not in measured:
+                second.append( bycount[n] )
+    results += schedule_options( second, run, jobs=jobs )
+    results.sort( key=lambda x: x[1] )
+    return results
+
+def option_resources( option ):
+    '''
+    Get the (cpus, gpu) that a beagle option occupies while it runs
+    cpus is the -beagle_instances count times the -beagle_threads count(each
+    1 without it) and gpu is True for -beagle_GPU options
+    '''
+    cpus = 1
+    for flag in ('-beagle_instances', '-beagle_threads'):
+        m = re.search( flag + ' (\d+)', option )
+        if m:
+            cpus *= int(m.group(1))
+    return cpus, '-beagle_GPU' in option
+
+def schedule_options( options, run, jobs=1, cpus=None,
+        resources=None ):
+    '''
+    Call run(option) for every option using up to jobs threads at once
+
+    Options are started in order but an option is held back while starting it
+    would make the -beagle_instances of everything running exceed cpus
+    (default cpu_count) or put two -beagle_GPU options on the gpus at the same
+    time, so concurrent runs do not slow each other down and skew the timings.
+    An option that needs more than cpus on its own runs by itself
+
+    resources - Function giving the (cpus, gpu) of an item of options.
+        Default option_resources
+
+    Returns the list of run results in the same order as options
+    '''
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    if resources is None:
+        resources = option_resources
+    results = [None] * len(options)
+    errors = []
+    pending = list(enumerate(options))
+    state = {'cpus': 0, 'gpu': False, 'running': 0}
+    cond = threading.Condition()
+
+    def fits( option ):
+        need, gpu = resources( option )
+        if state['running'] == 0:
+            return True
+        if state['running'] >= jobs or (gpu and state['gpu']):
+            return False
+        return state['cpus'] + need <= cpus
+
+    def worker( i, option ):
+        try:
+            results[i] = run( option )
+        except Exception as e:
+            errors.append( sys.exc_info() )
+        finally:
+            need, gpu = resources( option )
+            with cond:
+                state['cpus'] -= need
+                state['gpu'] = state['gpu'] and not gpu
+                state['running'] -= 1
+                cond.notify_all()
+
+    with cond:
+        while pending and not errors:
+            for p in pending:
+                if fits( p[1] ):
+                    break
+            else:
+                # Wait with a timeout so KeyboardInterrupt still gets through
+                cond.wait(1)
+                continue
+            pending.remove( p )
+            need, gpu = resources( p[1] )
+            state['cpus'] += need
+            state['gpu'] = state['gpu'] or gpu
+            state['running'] += 1
+            t = threading.Thread( target=worker, args=p )
+            t.daemon = True
+            t.start()
+        while state['running']:
+            cond.wait(1)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def option_to_kwargs( option ):
+    '''
+    Convert an option string from get_available_beagle_options into the
+    beast_options kwargs that estimate_beast_runtime takes
+    Each -flag is kept together with its value such as -beagle_instances 4
+    '''
+    beast_options = {}
+    for o in re.findall( '-\S+(?: [^-\s]\S*)?', option ):
+        beast_options[o] = True
+    return beast_options
+
+# One resource listed by beast -beagle_info
+# flags is the set of flags such as PROCESSOR_GPU or VECTOR_SSE
+BeagleResource = namedtuple( 'BeagleResource', 'index name flags' )
 
-def get_available_beagle_options( ):
+def get_beagle_info( cache=None ):
+    '''
+    Get the output of beast -beagle_info
+
+    cache - whip.cache.BeagleInfoCache to reuse the output from as long as
+        the beast and beagle library files have not changed since it was
+        stored
+    '''
+    fingerprint = None
+    if cache is not None:
+        fingerprint = beagle_fingerprint()
+        info = cache.get( fingerprint )
+        if info is not None:
+            return info
+    cmd = ['beast', '-beagle_info']
+    p = Popen(cmd, stdout=PIPE)
+    sout,serr = p.communicate()
+    if cache is not None and p.returncode == 0 and sout:
+        cache.put( fingerprint, sout )
+    return sout
+
+def beagle_files( ):
+    '''
+    Paths of the beast executable, the jars it runs and the beagle libraries
+    that beast -beagle_info output depends on
+    '''
+    paths = []
+    beast = find_executable( 'beast' )
+    if beast is not None:
+        beast = realpath( beast )
+        paths.append( beast )
+        # Beast installs keep beast.jar in lib next to bin
+        paths += sorted(glob.glob( join(dirname(dirname(beast)), 'lib', '*.jar') ))
+    libdirs = os.environ.get('LD_LIBRARY_PATH', '').split(os.pathsep)
+    libdirs += ['/usr/local/lib', '/usr/lib', '/usr/lib64']
+    for libdir in libdirs:
+        if libdir and isdir( libdir ):
+            paths += sorted(glob.glob( join(libdir, 'libhmsbeagle*') ))
+    return paths
+
+def beagle_fingerprint( ):
+    '''
+    List of [path, modification time] for every beagle_files path so cached
+    beagle info can be thrown away once beast or beagle is changed
+    '''
+    fingerprint = []
+    for path in beagle_files():
+        try:
+            fingerprint.append( [path, os.stat(path).st_mtime] )
+        except OSError as e:
+            continue
+    return fingerprint
+
+def parse_beagle_resources( beagle_info ):
+    '''
+    Parse the resources out of beast -beagle_info output into a list of
+    BeagleResource
+
+    beagle_info can also be only the resource listing without the header
+    '''
+    for header in ('BEAGLE resources available:\n', '--- BEAGLE RESOURCES ---\n'):
+        if header in beagle_info:
+            beagle_info = beagle_info.partition( header )[2]
+            break
+    resources = []
+    for line in beagle_info.splitlines():
+        m = re.match( '\s*(\d+)\s*:\s*(.*?)\s*$', line )
+        if m:
+            resources.append( [int(m.group(1)), m.group(2), frozenset()] )
+            continue
+        m = re.match( '\s*Flags:(.*)', line )
+        if m and resources:
+            resources[-1][2] = frozenset( m.group(1).split() )
+    return [BeagleResource(*r) for r in resources]
+
+def get_available_beagle_options( beagle_info=None, smart=False,
+        patterns=None, threads=False ):
     '''
     Return a list of beagle options that can be passed to beast
     Returns a list of options such as 
@@ -73,51 +853,66 @@ def get_available_beagle_options( ):
 
     Will only return -beagle_SSE or -beagle_CPU with preference of -beagle_SSE
      as SSE should always be faster than CPU
+
+    beagle_info - Output of get_beagle_info if it was already run
+    smart - Only use the instance_candidates counts for -beagle_instances
+        instead of every even number up to the cpu count and spread
+        instances over all gpus with -beagle_order
+    patterns - Site pattern count of the alignment to limit the smart
+        -beagle_instances counts with
+    threads - Also add -beagle_threads options for the cpu with the same
+        counts as -beagle_instances
     '''
-    cmd = ['beast', '-beagle_info']
-    p = Popen(cmd, stdout=PIPE)
-    sout,serr = p.communicate()
-    if 'BEAGLE resources available' in sout:
-      resourcelist = sout.rstrip().partition( 'BEAGLE resources available:\n' )[2]
-    else:
-      resourcelist = sout.rstrip().partition( '--- BEAGLE RESOURCES ---\n' )[2]
-    resourcelist = resourcelist.split('\n\n\n')
+    sout = beagle_info
+    if sout is None:
+        sout = get_beagle_info()
+    resources = parse_beagle_resources( sout )
     options = []
 
-    instances = []
-    for i in range(2, multiprocessing.cpu_count()+1, 2):
-        instances.append( '-beagle_instances {0}'.format(i) )
+    if smart:
+        counts = instance_candidates( patterns=patterns )
+    else:
+        counts = range(2, multiprocessing.cpu_count()+1, 2)
+    instances = ['-beagle_instances {0}'.format(i) for i in counts]
+    if threads:
+        instances += ['-beagle_threads {0}'.format(i) for i in counts]
 
-    # At some point probably should make another function for CPU resources
-    # like how get_gpu_options was done
-    for resource in resourcelist:
-        if 'CPU' in resource and '-beagle_SSE' not in options:
-            options.append( '-beagle_CPU' )
-            for inst in instances:
-                options.append( '-beagle_CPU ' + inst )
-        if 'VECTOR_SSE' in resource:
-            options.append( '-beagle_SSE' )
-            for inst in instances:
-                options.append( '-beagle_SSE ' + inst )
-                options.remove( '-beagle_CPU ' + inst )
-            options.remove( '-beagle_CPU' )
+    cpus = [r for r in resources if 'PROCESSOR_CPU' in r.flags]
+    if cpus:
+        base = '-beagle_CPU'
+        if any('VECTOR_SSE' in r.flags for r in cpus):
+            base = '-beagle_SSE'
+        options.append( base )
+        for inst in instances:
+            options.append( base + ' ' + inst )
 
     # Put GPU before CPU since that is correct ordering
-    options = get_gpu_options(resourcelist) + options
+    gpu_options = get_gpu_options(resources)
+    gpus = [r.index for r in resources if 'PROCESSOR_GPU' in r.flags]
+    if smart and len(gpus) > 1:
+        gpu_options.append( '-beagle_GPU -beagle_instances {0} -beagle_order {1}'.format(
+            len(gpus), ','.join(str(i) for i in gpus)) )
+    options = gpu_options + options
 
     return options
 
 def get_gpu_options( resourcelist ):
     '''
     Get a list of GPU options from resourcelist
+
+    resourcelist - BeagleResource list or raw -beagle_info resource strings
     '''
     options = []
     gpu_indexes = []
     for resource in resourcelist:
-        if 'GPU' in resource:
-            i = int(resource.split('\n')[0].split(':')[0].strip())
-            gpu_indexes.append( i )
-            options.append( '-beagle_GPU -beagle_order {0}'.format(i) )
+        if isinstance( resource, basestring ):
+            resources = parse_beagle_resources( resource )
+        else:
+            resources = [resource]
+        for resource in resources:
+            if 'PROCESSOR_GPU' in resource.flags:
+                gpu_indexes.append( resource.index )
+                options.append( '-beagle_GPU -beagle_order {0}'.format(resource.index) )
     # If there is only one gpu, then there is only one option
     if len(gpu_indexes) == 1:
         return ['-beagle_GPU']
@@ -132,7 +927,70 @@ def get_gpu_options( resourcelist ):
 
     return options
 
-def estimate_beast_runtime( xmlfile, seed=999, stream=sys.stdout, **beast_options ):
+# Fewest site patterns worth giving a beagle instance of its own
+MIN_PATTERNS_PER_INSTANCE = 500
+
+def physical_core_count( cpuinfo='/proc/cpuinfo' ):
+    '''
+    Number of physical cores(hyperthreads not counted) from cpuinfo
+    Falls back to the cpu count if cpuinfo cannot be read
+    '''
+    cores = set()
+    physical = None
+    try:
+        with open(cpuinfo) as fh:
+            for line in fh:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical = value.strip()
+                elif key == 'core id':
+                    cores.add( (physical, value.strip()) )
+    except IOError as e:
+        pass
+    if not cores:
+        return multiprocessing.cpu_count()
+    return len(cores)
+
+def numa_node_count( nodedir='/sys/devices/system/node' ):
+    '''
+    Number of NUMA nodes or 1 if it cannot be found
+    '''
+    nodes = glob.glob( join(nodedir, 'node[0-9]*') )
+    return max( 1, len(nodes) )
+
+def instance_candidates( cores=None, numa=None, patterns=None ):
+    '''
+    Short list of -beagle_instances counts worth trying
+
+    Powers of two up to the physical core count plus the core count itself
+    and, with more than one NUMA node, the node count and cores per node.
+    Counts that would leave an instance with fewer than
+    MIN_PATTERNS_PER_INSTANCE of the alignment's patterns are dropped
+
+    cores - Physical cores. Default physical_core_count()
+    numa - NUMA nodes. Default numa_node_count()
+    patterns - Site patterns in the alignment
+    '''
+    if cores is None:
+        cores = physical_core_count()
+    if numa is None:
+        numa = numa_node_count()
+    candidates = set([cores])
+    n = 2
+    while n < cores:
+        candidates.add( n )
+        n *= 2
+    if numa > 1:
+        candidates.add( numa )
+        candidates.add( cores // numa )
+    most = cores
+    if patterns is not None:
+        most = min( most, patterns // MIN_PATTERNS_PER_INSTANCE )
+    return sorted( c for c in candidates if 2 <= c <= most )
+
+def estimate_beast_runtime( xmlfile, seed=999, stream=sys.stdout, probe=False,
+        timeout=None, supervisor=None, **beast_options ):
     '''
     Run beast and wait for the first line that has the hours/million line
     Then terminate beast and calculate how long it would take to run based 
@@ -140,51 +998,203 @@ def estimate_beast_runtime( xmlfile, seed=999, stream=sys.stdout, **beast_option
 
     xmlfile - Input xml file to run beast on
     seed - Seed to set so all runs are the same
+    probe - Run a build_probe_xml copy of xmlfile instead of xmlfile itself
+    timeout/supervisor - See read_hours_per_million
+    beast_options is a kwargs set that you can specify any beast options
+    '''
+    readings = read_hours_per_million(
+        xmlfile, seed, stream, lambda readings: True, probe, timeout,
+        supervisor, **beast_options
+    )
+    # Compute some numbers
+    total_chains = get_chainlength( xmlfile )
+    return readings[0] * (total_chains / 1000000.0)
+
+def read_hours_per_million( xmlfile, seed, stream, enough, probe=False,
+        timeout=None, supervisor=None, **beast_options ):
+    '''
+    Run beast and collect the hours/million states readings from its output
+    until enough(readings) returns True or beast exits
+    Then terminate beast
+
+    xmlfile - Input xml file to run beast on
+    seed - Seed to set so all runs are the same
+    enough - Called with the list of readings after every new reading
+    probe - Run a build_probe_xml copy of xmlfile(written in the temp
+        directory) instead of xmlfile itself
+    timeout - Seconds to wait for enough readings before killing beast and
+        raising BeastTimeoutError
+    supervisor - BeastSupervisor to launch beast with so it can be cancelled
+        along with other runs
     beast_options is a kwargs set that you can specify any beast options
+
+    Returns the list of hours/million readings
+    Raises ValueError if there were none
     '''
     # Need the absolute path to the xml file since we enter a temp
     #  directory and reference the file from there
     xmlfile = abspath( xmlfile )
+    # Create a temporary directory to work in
+    tdir = tempfile.mkdtemp(prefix='beastoptimiser',suffix='run')
+    try:
+        return _collect_readings(
+            xmlfile, tdir, seed, stream, enough, probe, timeout, supervisor,
+            **beast_options
+        )
+    finally:
+        # Clean up our temp directory even if beast failed or timed out
+        shutil.rmtree( tdir, ignore_errors=True )
+
+def _collect_readings( xmlfile, tdir, seed, stream, enough, probe, timeout,
+        supervisor, **beast_options ):
+    '''
+    Body of read_hours_per_million run inside its temp directory tdir
+    '''
+    if probe:
+        xmlfile = build_probe_xml( xmlfile, join(tdir, 'probe.xml') )
     # Build Beast options to run
     cmd = ['beast', '-overwrite', '-seed {0}'.format(seed)]
     cmd += kwargs_to_options( **beast_options )
     cmd += [xmlfile]
-    # Create a temporary directory to work in
-    tdir = tempfile.mkdtemp(prefix='beastoptimiser',suffix='run')
     # Send the command ran to stream
     stream.write( ' '.join(cmd) + '\n' )
-    p = Popen( cmd, stdout=PIPE, stderr=PIPE, cwd=tdir )
-    # Loop through beast output
-    for line in p.stdout:
-        # Send all output to output stream
-        stream.write( line )
-        # Parse each output line
-        hours_per_million = get_hours_per_million( line )
-        # First line that returns an actual result for hours/million states
-        if hours_per_million is not None:
-            # No longer need to run beast
-            p.kill()
-            # Exit looping over output
-            break
-    # Make sure we actually got what we were looking for
-    if hours_per_million is None:
-        p.wait()
-        if p.returncode != 0:
-            stream.write( '!!!!!!!!!!!! Beast did not exit correctly !!!!!!!!!!!!!!!!!!\n' )
-            stream.write( 'Here is the remaining output:\n' )
-            stream.write( p.stderr.read() )
-            stream.write( '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n' )
+    if supervisor is None:
+        supervisor = BeastSupervisor()
+    p = supervisor.launch( cmd, tdir, timeout )
+    readings = []
+    try:
+        # Loop through beast output
+        for line in p.lines():
+            # Send all output to output stream
+            stream.write( line )
+            # Parse each output line
+            hours_per_million = get_hours_per_million( line )
+            if hours_per_million is not None:
+                readings.append( hours_per_million )
+                if enough( readings ):
+                    # No longer need to run beast
+                    p.kill()
+                    # Exit looping over output
+                    break
+        # Make sure we actually got what we were looking for
+        if not readings:
+            if p.wait() != 0:
+                stream.write( '!!!!!!!!!!!! Beast did not exit correctly !!!!!!!!!!!!!!!!!!\n' )
+                stream.write( 'Here is the remaining output:\n' )
+                stream.write( p.error_output() )
+                stream.write( '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n' )
+            raise ValueError( "Initial hours/million state was not found in output" )
+    finally:
         # Ensure beast is dead
-        if p.poll() is None:
-            p.kill()
-        raise ValueError( "Initial hours/million state was not found in output" )
-    # Compute some numbers
-    total_chains = get_chainlength( xmlfile )
-    hours = hours_per_million * (total_chains / 1000000.0)
-    # Clean up our temp directory if retcode was 0
-    shutil.rmtree( tdir )
+        p.kill()
+        supervisor.finished( p )
     # Return the goodness
-    return hours
+    return readings
+
+# Two sided 95% t critical values by degrees of freedom
+T_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042,
+}
+
+# Result of sampling the runtime of an option
+# hours - Mean estimated hours
+# lower/upper - 95% confidence interval of hours
+# samples - hours/million readings that were used
+RuntimeEstimate = namedtuple( 'RuntimeEstimate', 'hours lower upper samples' )
+
+def summarize_samples( samples, chainlength ):
+    '''
+    Turn hours/million readings into a RuntimeEstimate for chainlength states
+    A single reading has an unbounded confidence interval
+    '''
+    scale = chainlength / 1000000.0
+    n = len(samples)
+    mean = sum(samples) / float(n)
+    if n < 2:
+        return RuntimeEstimate( mean * scale, 0.0, float('inf'), samples )
+    var = sum((x - mean) ** 2 for x in samples) / (n - 1)
+    df = n - 1
+    # Use the closest tabled degrees of freedom at or below df(wider interval)
+    t = 1.96
+    if df <= max(T_95):
+        t = T_95[max(d for d in T_95 if d <= df)]
+    half = t * (var / n) ** 0.5
+    return RuntimeEstimate(
+        mean * scale, max(0.0, mean - half) * scale, (mean + half) * scale,
+        samples
+    )
+
+def sample_beast_runtime( xmlfile, seed=999, stream=sys.stdout, samples=5,
+        discard=1, maxtime=None, stop_above=None, probe=False, timeout=None,
+        supervisor=None, **beast_options ):
+    '''
+    Like estimate_beast_runtime but keeps reading the screen log to get a
+    more reliable estimate than the first(noisiest) reading
+
+    samples - How many readings to keep
+    discard - How many warm up readings to throw away first
+    maxtime - Stop after this many seconds even with fewer readings
+    stop_above - Stop as soon as the lower end of the confidence interval is
+        above this many hours, since the option is clearly slower than that
+    probe - Run a build_probe_xml copy of xmlfile instead of xmlfile itself
+    timeout/supervisor - See read_hours_per_million
+
+    If beast stops before there are more readings than discard the last
+    reading is used
+
+    Returns a RuntimeEstimate
+    '''
+    chainlength = get_chainlength( xmlfile )
+    start = time.time()
+    def enough( readings ):
+        kept = readings[discard:]
+        if len(kept) >= samples:
+            return True
+        if maxtime is not None and time.time() - start > maxtime:
+            return True
+        if stop_above is not None and len(kept) >= 2:
+            return summarize_samples( kept, chainlength ).lower > stop_above
+        return False
+    readings = read_hours_per_million(
+        xmlfile, seed, stream, enough, probe, timeout, supervisor,
+        **beast_options
+    )
+    kept = readings[discard:] or readings[-1:]
+    return summarize_samples( kept, chainlength )
+
+# States between screen log lines and lines logged by build_probe_xml
+PROBE_LOGEVERY = 1000
+PROBE_ROWS = 100
+
+def build_probe_xml( xmlfile, probefile, logevery=PROBE_LOGEVERY,
+        rows=PROBE_ROWS ):
+    '''
+    Write a copy of xmlfile to probefile that is only good for timing
+        - chainLength is cut to logevery * rows states(or left alone if it
+          is already shorter)
+        - screen logs(log tags without a fileName) print every logevery states
+        - every fileName is pointed at os.devnull so no log or tree files
+          are written
+
+    The estimate should still be extrapolated with get_chainlength of the
+    original xmlfile
+
+    Returns probefile
+    '''
+    xml = etree.parse( xmlfile )
+    for element in xml.findall('.//*[@chainLength]'):
+        chainlength = min(int(element.attrib['chainLength']), logevery * rows)
+        element.attrib['chainLength'] = str(chainlength)
+    for log in xml.findall('.//log'):
+        if 'fileName' not in log.attrib:
+            log.attrib['logEvery'] = str(logevery)
+    for element in xml.findall('.//*[@fileName]'):
+        element.attrib['fileName'] = os.devnull
+        if 'overwrite' in element.attrib:
+            element.attrib['overwrite'] = 'true'
+    xml.write( probefile )
+    return probefile
 
 def pretty_time( hours_float ):
     '''
@@ -0,0 +1,365 @@
+'''
+On disk caches so repeated runs on the same machine do not have to redo
+expensive work
+'''
+
+import os
+from os.path import join, expanduser, dirname, exists, realpath
+import json
+import time
+import hashlib
+import socket
+import threading
+import tempfile
+import shutil
+import re
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+
+from whip.alignment import AlignmentStore
+
+def cache_dir( ):
+    '''
+    Directory caches are kept in
+    $BEAST_WHIP_CACHE if it is set otherwise ~/.cache/beast_whip
+    '''
+    path = os.environ.get('BEAST_WHIP_CACHE')
+    if not path:
+        path = join(expanduser('~'), '.cache', 'beast_whip')
+    return path
+
+def file_hash( path ):
+    '''
+    sha1 hex digest of a file's contents
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024*1024), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def file_stamp( path ):
+    '''
+    [size, modification time] of a file which changes whenever it is
+    rewritten and is much quicker to get than its file_hash
+    '''
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+def beast_version( beagle_info ):
+    '''
+    Pull the BEAST version out of the banner of beast -beagle_info output
+    Returns None if it cannot be found
+    '''
+    m = re.search( 'BEAST v(\d[\w.]*)', beagle_info )
+    if m:
+        return m.group(1)
+    return None
+
+def host_fingerprint( beagle_info ):
+    '''
+    sha1 hex digest of the host name and its beast -beagle_info output
+    '''
+    return hashlib.sha1(
+        socket.gethostname() + '\0' + beagle_info
+    ).hexdigest()
+
+def estimate_key( xmlhash, beagle_info, option, mode=None ):
+    '''
+    Cache key for an estimate of running an xml with option on this host
+
+    Made from the hash of the xml, the BEAST version, a fingerprint of the
+    host name and its beagle resources and the option string
+
+    xmlhash - file_hash of the xml. Taken instead of the file so it is only
+        hashed once for all of its options
+    mode - How the estimate was made when it was not a run of the whole xml
+        such as 'probe logevery=1000 rows=100'
+    '''
+    parts = [
+        xmlhash,
+        str(beast_version(beagle_info)),
+        host_fingerprint(beagle_info),
+        option
+    ]
+    if mode is not None:
+        parts.append( mode )
+    return hashlib.sha1( '\0'.join(parts) ).hexdigest()
+
+@contextmanager
+def file_lock( path ):
+    '''
+    Hold an exclusive lock on the lock file path(created if needed) so
+    other processes using the same path wait for it
+    '''
+    directory = dirname(path)
+    if not exists(directory):
+        os.makedirs(directory)
+    with open(path, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+class EstimateCache(object):
+    '''
+    JSON lines store of estimated hours keyed by estimate_key
+
+    Entries older than ttl seconds are ignored and dropped and only the
+    newest maxentries are kept whenever the store is written
+
+    Every put reloads the store under a lock file and merges it in before
+    writing so processes sharing the store keep each other's entries
+    '''
+    def __init__( self, path=None, ttl=30*24*3600, maxentries=10000 ):
+        if path is None:
+            path = join(cache_dir(), 'estimates.jsonl')
+        self.path = path
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._load()
+
+    def _load( self ):
+        if not exists(self.path):
+            return
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip lines from interrupted writes
+                    continue
+                # Keep whichever of ours and theirs is newer
+                old = self.entries.get(entry['key'])
+                if old is None or old['time'] <= entry['time']:
+                    self.entries[entry['key']] = entry
+
+    def _expired( self, entry, now ):
+        return now - entry['time'] > self.ttl
+
+    def get( self, key ):
+        '''
+        Get the cached entry for key or None if it is missing or expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry, time.time()):
+                return None
+            return entry
+
+    def put( self, key, hours, **info ):
+        '''
+        Store hours for key along with any extra info and write the store
+        '''
+        with self.lock:
+            with file_lock(self.path + '.lock'):
+                self._load()
+                entry = dict(info, key=key, hours=hours, time=time.time())
+                self.entries[key] = entry
+                self._evict()
+                self._write()
+
+    def _evict( self ):
+        now = time.time()
+        live = [e for e in self.entries.values() if not self._expired(e, now)]
+        live.sort( key=lambda e: e['time'], reverse=True )
+        self.entries = dict((e['key'], e) for e in live[:self.maxentries])
+
+    def _write( self ):
+        # Write to a temp file and rename so readers never see half a store
+        directory = dirname(self.path)
+        if not exists(directory):
+            os.makedirs(directory)
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.estimates')
+        with os.fdopen(fd, 'w') as fh:
+            for entry in sorted(self.entries.values(), key=lambda e: e['time']):
+                fh.write( json.dumps(entry) + '\n' )
+        os.rename(tmppath, self.path)
+
+class BeagleInfoCache(object):
+    '''
+    JSON store of beast -beagle_info output for each host
+
+    Each host's output is stored with a fingerprint of the beast and beagle
+    files it came from and is only used while the fingerprint still matches
+    '''
+    def __init__( self, path=None, host=None ):
+        if path is None:
+            path = join(cache_dir(), 'beagle_info.json')
+        if host is None:
+            host = socket.gethostname()
+        self.path = path
+        self.host = host
+
+    def _load( self ):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def get( self, fingerprint ):
+        '''
+        Get the stored beagle info for this host or None if it is missing
+        or was stored for different beast/beagle files
+        '''
+        entry = self._load().get(self.host)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return entry['info']
+
+    def put( self, fingerprint, info ):
+        '''
+        Store info for this host
+        '''
+        hosts = self._load()
+        hosts[self.host] = {
+            'fingerprint': fingerprint, 'info': info, 'time': time.time()
+        }
+        directory = dirname(self.path)
+        if not exists(directory):
+            os.makedirs(directory)
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.beagle_info')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(hosts, fh)
+        os.rename(tmppath, self.path)
+
+class PackedStrings(object):
+    '''
+    Read only list of strings stored back to back in one memory mapped file
+    with their offsets next to it in a .npy file
+    '''
+    def __init__( self, data, offsets ):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def write( path, strings ):
+        '''
+        Write strings to path and their offsets to path.npy
+        '''
+        offsets = [0]
+        with open(path, 'wb') as fh:
+            for string in strings:
+                fh.write( string )
+                offsets.append( offsets[-1] + len(string) )
+        np.save( path + '.npy', np.array(offsets, dtype=np.int64) )
+
+    @classmethod
+    def load( cls, path ):
+        offsets = np.load( path + '.npy' )
+        if offsets[-1] == 0:
+            # Empty files cannot be memory mapped
+            data = np.zeros( 0, dtype=np.uint8 )
+        else:
+            data = np.memmap( path, dtype=np.uint8, mode='r' )
+        return cls( data, offsets )
+
+    def __len__( self ):
+        return len(self.offsets) - 1
+
+    def __getitem__( self, i ):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+
+class SplitCache(object):
+    '''
+    Store of parsed xml files for split_xml so splitting the same file again
+    does not have to parse it
+
+    Every xml file has one entry holding its serialized template, taxa and
+    sequences as PackedStrings and its AlignmentStore, which are all memory
+    mapped when read back. An entry is only used while the file_stamp of the
+    xml file still matches and is replaced when it does not
+
+    Entries not used for ttl seconds are dropped and the least recently
+    used entries are dropped until all of them fit in maxbytes whenever an
+    entry is stored, so an xml too big for maxbytes is never kept
+    '''
+    def __init__( self, path=None, ttl=7*24*3600, maxbytes=10*1024**3 ):
+        if path is None:
+            path = join(cache_dir(), 'splits')
+        self.path = path
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+
+    def _entry( self, xmlfile ):
+        return join(self.path, hashlib.sha1(realpath(xmlfile)).hexdigest())
+
+    def get( self, xmlfile ):
+        '''
+        Get (template, taxa, sequences, store) of xmlfile or None if it is
+        missing or xmlfile has changed since it was stored
+        '''
+        entry = self._entry(xmlfile)
+        try:
+            with open(join(entry, 'stamp.json')) as fh:
+                stamp = json.load(fh)
+            if stamp != file_stamp(xmlfile):
+                return None
+            with open(join(entry, 'template.xml'), 'rb') as fh:
+                template = fh.read()
+            cached = (
+                template,
+                PackedStrings.load(join(entry, 'taxa')),
+                PackedStrings.load(join(entry, 'sequences')),
+                AlignmentStore.load(join(entry, 'alignment'))
+            )
+            # The stamp's mtime records when the entry was last used
+            os.utime(join(entry, 'stamp.json'), None)
+        except (IOError, OSError, ValueError):
+            # Missing, half written or half removed
+            return None
+        return cached
+
+    def put( self, xmlfile, template, taxa, sequences, store ):
+        '''
+        Store the parsed pieces of xmlfile replacing any older entry
+        '''
+        if not exists(self.path):
+            os.makedirs(self.path)
+        # Build the entry next to where it goes and swap it in when complete
+        tmpdir = tempfile.mkdtemp(dir=self.path, prefix='.entry')
+        try:
+            with open(join(tmpdir, 'template.xml'), 'wb') as fh:
+                fh.write(template)
+            PackedStrings.write(join(tmpdir, 'taxa'), taxa)
+            PackedStrings.write(join(tmpdir, 'sequences'), sequences)
+            store.save(join(tmpdir, 'alignment'))
+            with open(join(tmpdir, 'stamp.json'), 'w') as fh:
+                json.dump(file_stamp(xmlfile), fh)
+            entry = self._entry(xmlfile)
+            if exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpdir, entry)
+        except BaseException:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+        self._evict()
+
+    def _evict( self ):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            entry = join(self.path, name)
+            try:
+                used = os.stat(join(entry, 'stamp.json')).st_mtime
+                size = 0
+                for dirpath, dirnames, filenames in os.walk(entry):
+                    for filename in filenames:
+                        size += os.path.getsize(join(dirpath, filename))
+            except OSError:
+                # Being built or removed by someone else
+                continue
+            entries.append( (used, size, entry) )
+        # Newest first so the oldest are dropped once maxbytes is used up
+        entries.sort( reverse=True )
+        total = 0
+        for used, size, entry in entries:
+            total += size
+            if now - used > self.ttl or total > self.maxbytes:
+                shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,115 @@
+'''
+Open files that are compressed, picking the codec from the file extension
+
+gzip is always available. xz needs lzma(backports.lzma on python 2) and
+zstd needs zstandard
+'''
+
+import gzip
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec name -> file extension
+EXTENSIONS = {
+    'gz': '.gz',
+    'xz': '.xz',
+    'zst': '.zst',
+}
+
+class ZstdFile(object):
+    '''
+    File like zstd stream over a plain file as zstandard has no open on
+    python 2
+    '''
+    def __init__( self, path, mode ):
+        self.fh = open( path, mode )
+        self.writing = 'w' in mode
+        if self.writing:
+            self.stream = zstandard.ZstdCompressor().stream_writer( self.fh )
+        else:
+            self.stream = zstandard.ZstdDecompressor().stream_reader( self.fh )
+
+    def read( self, size=-1 ):
+        if size is None or size < 0:
+            return ''.join( iter(lambda: self.stream.read(1024*1024), '') )
+        return self.stream.read( size )
+
+    def write( self, data ):
+        self.stream.write( data )
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def close( self ):
+        if self.fh.closed:
+            return
+        try:
+            if self.writing:
+                # Ends the frame so the file can be decompressed
+                self.stream.flush( zstandard.FLUSH_FRAME )
+        finally:
+            self.fh.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+
+def compression( path ):
+    '''
+    Codec name of path from its extension or None if it is not compressed
+    '''
+    for codec, ext in EXTENSIONS.items():
+        if path.endswith( ext ):
+            return codec
+    return None
+
+def strip_compression( path ):
+    '''
+    path without its compression extension
+    '''
+    codec = compression( path )
+    if codec is None:
+        return path
+    return path[:-len(EXTENSIONS[codec])]
+
+def open_file( path, mode='r' ):
+    '''
+    Open path in binary mode for reading(r) or writing(w), streaming it
+    through the codec its extension names
+
+    Raises ValueError if the module the codec needs is not installed
+    '''
+    mode = mode.rstrip('b') + 'b'
+    codec = compression( path )
+    if codec is None:
+        return open( path, mode )
+    elif codec == 'gz':
+        # Level 6 is what gzip itself uses and is a lot quicker than 9
+        return gzip.open( path, mode, compresslevel=6 )
+    elif codec == 'xz':
+        if lzma is None:
+            raise ValueError(
+                'Reading or writing {0} needs the lzma module. Install ' \
+                'backports.lzma'.format(path)
+            )
+        return lzma.open( path, mode )
+    if zstandard is None:
+        raise ValueError(
+            'Reading or writing {0} needs the zstandard module. Install ' \
+            'zstandard'.format(path)
+        )
+    return ZstdFile( path, mode )
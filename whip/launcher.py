@@ -0,0 +1,158 @@
+'''
+Run split xml files with beast on the local machine
+'''
+
+import os
+from os.path import join, abspath, basename, splitext, exists
+import sys
+import re
+import threading
+import multiprocessing
+
+from whip.beagleoptimiser import (
+    BeastSupervisor,
+    get_chainlength,
+    get_hours_per_million,
+    option_resources,
+    pretty_time,
+    schedule_options,
+)
+
+class Progress(object):
+    '''
+    How far a beast run has got from its screen log
+
+    state - Last state printed
+    hours_per_million - Last hours/million states printed
+    status - waiting, running, done or failed
+    '''
+    def __init__( self, xmlfile, chainlength ):
+        self.xmlfile = xmlfile
+        self.chainlength = chainlength
+        self.state = 0
+        self.hours_per_million = None
+        self.status = 'waiting'
+        self.returncode = None
+
+    def update( self, line ):
+        '''
+        Update from a line of beast output
+        '''
+        m = re.match( '\s*(\d+)\s', line )
+        if m is None:
+            return
+        self.state = int(m.group(1))
+        hours_per_million = get_hours_per_million( line )
+        if hours_per_million is not None:
+            self.hours_per_million = hours_per_million
+
+    def fraction( self ):
+        if not self.chainlength:
+            return 0.0
+        return min( 1.0, self.state / float(self.chainlength) )
+
+    def remaining( self ):
+        '''
+        Estimated hours left or None before the first hours/million reading
+        '''
+        if self.hours_per_million is None:
+            return None
+        left = max( 0, self.chainlength - self.state )
+        return left / 1000000.0 * self.hours_per_million
+
+    def __str__( self ):
+        msg = '{0} {1}'.format( basename(self.xmlfile), self.status )
+        if self.status == 'running':
+            msg += ' {0:.0%} ({1}/{2} states)'.format(
+                self.fraction(), self.state, self.chainlength)
+            if self.remaining() is not None:
+                msg += ' ETA {0}'.format(pretty_time(self.remaining()))
+        elif self.status == 'failed':
+            msg += ' (exit {0})'.format(self.returncode)
+        return msg
+
+def run_dir( outdir, xmlfile ):
+    '''
+    Working directory a split file is run in
+    '''
+    return join( outdir, splitext(basename(xmlfile))[0] )
+
+def run_split( xmlfile, option, workdir, progress, supervisor=None ):
+    '''
+    Run beast with option on xmlfile inside workdir, which is where beast
+    writes its log files, keeping progress up to date
+    All of the beast output is kept in workdir/beast.out
+
+    supervisor - BeastSupervisor to launch beast with
+
+    Returns the beast exit code
+    '''
+    if not exists( workdir ):
+        os.makedirs( workdir )
+    cmd = ['beast'] + option.split() + [abspath(xmlfile)]
+    if supervisor is None:
+        supervisor = BeastSupervisor()
+    p = supervisor.launch( cmd, workdir )
+    progress.status = 'running'
+    try:
+        with open(join(workdir, 'beast.out'), 'w') as fh:
+            for line in p.lines():
+                fh.write( line )
+                progress.update( line )
+            returncode = p.wait()
+            fh.write( p.error_output() )
+    finally:
+        p.kill()
+        supervisor.finished( p )
+    progress.returncode = returncode
+    progress.status = 'done' if returncode == 0 else 'failed'
+    return returncode
+
+def launch_splits( xmlfiles, option='', outdir='.', cpus=None,
+        stream=sys.stdout, interval=60 ):
+    '''
+    Run every xmlfile with beast and the beagle option on this machine
+
+    As many files run at the same time as their -beagle_instances fit in
+    cpus(default cpu_count), see schedule_options. Each file runs in its
+    own run_dir in outdir and a line of progress per file is written to
+    stream every interval seconds
+
+    Returns the Progress of every file in xmlfiles order
+    '''
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    progress = [Progress(x, get_chainlength(x)) for x in xmlfiles]
+    need = option_resources( option )
+    supervisor = BeastSupervisor()
+    done = threading.Event()
+
+    def report():
+        for p in progress:
+            stream.write( str(p) + '\n' )
+        stream.flush()
+
+    def monitor():
+        while not done.wait( interval ):
+            report()
+
+    reporter = threading.Thread( target=monitor )
+    reporter.daemon = True
+    reporter.start()
+    try:
+        schedule_options(
+            progress,
+            lambda p: run_split(
+                p.xmlfile, option, run_dir(outdir, p.xmlfile), p, supervisor
+            ),
+            jobs=len(progress), cpus=cpus, resources=lambda p: need
+        )
+    except BaseException:
+        # Do not leave beasts running in the background
+        supervisor.cancel()
+        raise
+    finally:
+        done.set()
+        reporter.join()
+    report()
+    return progress
@@ -0,0 +1,263 @@
+'''
+Sweep beagle options over many hosts through a shared directory
+
+The queue directory(on NFS or any directory every host mounts) holds
+    xml/<task>.xml          Copies of the xml files to sweep
+    claims/<class>/<id>     Lock files of the options being run
+    results/<class>/<id>    BeastRun.as_dict json of every finished option
+
+Hosts with the same beagle resources, BEAST version and core count form a
+host class. Every class sweeps every option of every xml once and the hosts
+of a class share that work by claiming options with exclusively created
+lock files
+'''
+
+import os
+from os.path import join, exists, basename, splitext
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
+import errno
+
+from whip.cache import file_hash, beast_version
+from whip.beagleoptimiser import (
+    BeastRun,
+    BeastTimeoutError,
+    estimate_beast_runtime,
+    get_available_beagle_options,
+    get_beagle_info,
+    option_to_kwargs,
+    parse_beagle_resources,
+    physical_core_count,
+    pretty_time,
+)
+
+def host_class( beagle_info, cores=None ):
+    '''
+    Short id shared by hosts with the same beagle resources, BEAST version
+    and physical core count
+    '''
+    if cores is None:
+        cores = physical_core_count()
+    parts = [str(beast_version(beagle_info)), str(cores)]
+    for resource in parse_beagle_resources( beagle_info ):
+        parts.append( resource.name + ' ' + ' '.join(sorted(resource.flags)) )
+    return hashlib.sha1( '\0'.join(parts) ).hexdigest()[:12]
+
+def describe_host_class( beagle_info, cores=None ):
+    '''
+    Human readable summary of what makes up a host_class
+    '''
+    if cores is None:
+        cores = physical_core_count()
+    names = [r.name for r in parse_beagle_resources( beagle_info )]
+    return 'BEAST {0}, {1} cores, {2}'.format(
+        beast_version(beagle_info), cores, ', '.join(names))
+
+def option_id( task, option ):
+    '''
+    File name safe id of running option on task
+    '''
+    return '{0}-{1}'.format( task, hashlib.sha1(option).hexdigest()[:12] )
+
+def init_queue( queuedir, xmlfiles ):
+    '''
+    Create queuedir and copy xmlfiles into it so every host reads the same
+    files no matter where it mounts the queue
+
+    Returns the task ids(xml content hashes) that were added
+    '''
+    xmldir = join( queuedir, 'xml' )
+    for d in (xmldir, join(queuedir, 'claims'), join(queuedir, 'results')):
+        if not exists( d ):
+            os.makedirs( d )
+    tasks = []
+    for xmlfile in xmlfiles:
+        task = file_hash( xmlfile )[:12]
+        shutil.copy( xmlfile, join(xmldir, task + '.xml') )
+        with open(join(xmldir, task + '.name'), 'w') as fh:
+            fh.write( basename(xmlfile) )
+        tasks.append( task )
+    return tasks
+
+def queue_tasks( queuedir ):
+    '''
+    Task ids in queuedir sorted so every host walks them in the same order
+    '''
+    xmls = os.listdir( join(queuedir, 'xml') )
+    return sorted( splitext(x)[0] for x in xmls if x.endswith('.xml') )
+
+def task_name( queuedir, task ):
+    '''
+    Original file name of a task's xml
+    '''
+    with open(join(queuedir, 'xml', task + '.name')) as fh:
+        return fh.read()
+
+def claim( path, stale=None ):
+    '''
+    Create the lock file path if nobody else has
+    O_EXCL creation is atomic on local file systems and NFSv3 and later
+
+    stale - Seconds after which another host's lock is considered abandoned
+        and is taken over
+
+    Returns True if the lock was taken
+    '''
+    try:
+        fd = os.open( path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644 )
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        if stale is None:
+            return False
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError as e:
+            # Released in the meantime
+            return claim( path )
+        if age <= stale:
+            return False
+        # Only one host can rename the stale lock away
+        try:
+            os.rename( path, path + '.stale.' + socket.gethostname() )
+        except OSError as e:
+            return False
+        return claim( path )
+    with os.fdopen(fd, 'w') as fh:
+        fh.write( '{0} {1}\n'.format(socket.gethostname(), os.getpid()) )
+    return True
+
+def write_result( path, result ):
+    '''
+    Atomically write result as json to path
+    '''
+    fd, tmppath = tempfile.mkstemp( dir=os.path.dirname(path), prefix='.result' )
+    with os.fdopen(fd, 'w') as fh:
+        json.dump( result, fh )
+    os.rename( tmppath, path )
+
+def work( queuedir, stream=sys.stdout, beagle_info=None, stale=None,
+        timeout=None, probe=False ):
+    '''
+    Run every option of every task in queuedir that no host of this host's
+    class has claimed yet
+
+    stale - Take over claims older than this many seconds(see claim)
+    timeout/probe - See run_beast_options
+
+    Returns the BeastRuns this host finished
+    '''
+    if beagle_info is None:
+        beagle_info = get_beagle_info()
+    hclass = host_class( beagle_info )
+    claimdir = join( queuedir, 'claims', hclass )
+    resultdir = join( queuedir, 'results', hclass )
+    for d in (claimdir, resultdir):
+        if not exists( d ):
+            try:
+                os.makedirs( d )
+            except OSError as e:
+                # Another host of the class made it
+                pass
+    with open(join(resultdir, 'class.txt'), 'w') as fh:
+        fh.write( describe_host_class(beagle_info) + '\n' )
+    runs = []
+    options = get_available_beagle_options( beagle_info )
+    for task in queue_tasks( queuedir ):
+        xmlfile = join( queuedir, 'xml', task + '.xml' )
+        for option in options:
+            oid = option_id( task, option )
+            if exists( join(resultdir, oid + '.json') ):
+                continue
+            if not claim( join(claimdir, oid), stale ):
+                continue
+            print "Running beast with {0} on {1}".format(
+                option, task_name(queuedir, task))
+            start = time.time()
+            status = 'ok'
+            try:
+                hours = estimate_beast_runtime(
+                    xmlfile, seed=999, stream=stream, probe=probe,
+                    timeout=timeout, **option_to_kwargs(option)
+                )
+            except BeastTimeoutError as e:
+                hours = sys.maxint
+                status = 'timeout'
+            except ValueError as e:
+                hours = sys.maxint
+                status = 'error'
+            run = BeastRun(
+                option, hours, status, time.time() - start,
+                xmlfile=task_name(queuedir, task), host=socket.gethostname(),
+                fingerprint=hclass, beast_version=beast_version(beagle_info),
+                task=task
+            )
+            write_result( join(resultdir, oid + '.json'), run.as_dict() )
+            runs.append( run )
+    return runs
+
+def load_results( queuedir ):
+    '''
+    Every finished result in queuedir
+
+    Returns a dictionary of host class -> (description, list of BeastRun)
+    '''
+    classes = {}
+    resultsdir = join( queuedir, 'results' )
+    for hclass in sorted(os.listdir( resultsdir )):
+        classdir = join( resultsdir, hclass )
+        description = ''
+        if exists( join(classdir, 'class.txt') ):
+            with open(join(classdir, 'class.txt')) as fh:
+                description = fh.read().strip()
+        runs = []
+        for name in sorted(os.listdir( classdir )):
+            if not name.endswith( '.json' ):
+                continue
+            with open(join(classdir, name)) as fh:
+                d = json.load( fh )
+            if d['hours'] is None:
+                d['hours'] = sys.maxint
+            runs.append( BeastRun(
+                d['option'], d['hours'], d['status'], d['elapsed'],
+                d['samples'], d['xmlfile'], d['host'], d['fingerprint'],
+                d['beast_version'], d.get('task')
+            ) )
+        classes[hclass] = (description, runs)
+    return classes
+
+def merge( queuedir, stream=sys.stdout ):
+    '''
+    Write a table of each host class's options ranked by estimated hours
+    for every xml to stream
+
+    xmls are told apart by task as different files can share a name
+
+    Returns the ranked BeastRuns of every class and xml
+    '''
+    ranked = []
+    for hclass, (description, runs) in sorted(load_results( queuedir ).items()):
+        hosts = sorted(set( run.host for run in runs ))
+        stream.write( 'Host class {0}: {1}\n'.format(hclass, description) )
+        stream.write( '  Hosts: {0}\n'.format(', '.join(hosts)) )
+        tasks = sorted(set( (run.xmlfile, run.task) for run in runs ))
+        for xmlfile, task in tasks:
+            stream.write( '  {0} ({1})\n'.format(xmlfile, task) )
+            xmlruns = sorted(
+                [run for run in runs if run.task == task],
+                key=lambda run: run[1]
+            )
+            for rank, run in enumerate(xmlruns, start=1):
+                if run.status in ('ok', 'cached'):
+                    result = pretty_time( run.hours )
+                else:
+                    result = run.status
+                stream.write( '    {0}. {1} {2} ({3})\n'.format(
+                    rank, run.option, result, run.host) )
+            ranked += xmlruns
+    return ranked
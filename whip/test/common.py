@@ -5,6 +5,8 @@ import tempfile
 import shutil
 import subprocess
 import multiprocessing
+import threading
+import time
 import random
 from StringIO import StringIO
 import contextlib
@@ -66,13 +68,23 @@ class BeastBase(MultipleInhBase):
         sout = Mock()
         sout.read = stdout
         sout.__iter__ = wait_stdout
+        # readline keeps the newline and gives '' only at the end
+        souts = (line + '\n' for line in wait_stdout(sout))
+        sout.readline = lambda: next(souts, '')
 
         serr = Mock()
         serr.read = stderr
         serr.__iter__ = wait_stderr
+        serrs = (line + '\n' for line in wait_stderr(serr))
+        serr.readline = lambda: next(serrs, '')
         
         m.return_value.stdout = sout
         m.return_value.stderr = serr
+        # Above the largest pid_max so killing its process group never
+        #  touches a real process
+        m.return_value.pid = 2**22 + 1
+        # Still running until waited for
+        m.return_value.poll.return_value = None
         return m
 
     def mock_beast( self, hpm, sleeptime=0.01 ):
@@ -0,0 +1,141 @@
+from common import *
+import numpy
+
+def store_rows( residues ):
+    from whip.alignment import AlignmentStore
+    return AlignmentStore.from_residues( range(len(residues)), residues ).rows()
+
+class Base(BaseTester):
+    modulepath = 'whip.alignment'
+
+class TestColumnPatterns(Base):
+    functionname = 'column_patterns'
+
+    def test_weights_and_inverse( self ):
+        inverse, counts = self._C( store_rows( ['AAAT', 'CCCT'] ) )
+        eq_( [1, 3], sorted(counts.tolist()) )
+        eq_( 4, counts.sum() )
+        # First three columns share a pattern
+        eq_( 1, len(set(inverse[:3].tolist())) )
+        ok_( inverse[3] != inverse[0] )
+
+class TestCountPatterns(Base):
+    functionname = 'count_patterns'
+
+    def test_matches_python_count( self ):
+        rand = random.Random(1)
+        residues = [
+            ''.join(rand.choice('ACGT-') for i in range(300)) for j in range(5)
+        ]
+        eq_( len(set(zip(*residues))), self._C( store_rows(residues) ) )
+
+    def test_no_sequences( self ):
+        eq_( 0, self._C( store_rows([]) ) )
+
+class TestHammingDistances(Base):
+    functionname = 'hamming_distances'
+
+    def test_differing_columns( self ):
+        m = store_rows( ['ACGT', 'ACGA', 'TTTT'] )
+        eq_( [0, 1, 3], self._C( m, 0 ).tolist() )
+
+    def test_blocks_give_same_distances( self ):
+        rand = random.Random(1)
+        residues = [
+            ''.join(rand.choice('ACGT') for i in range(40)) for j in range(25)
+        ]
+        m = store_rows( residues )
+        whole = self._C( m, 3 ).tolist()
+        # 3 rows of 40 columns per block
+        with patch('whip.alignment.HAMMING_BLOCK_CELLS', 120):
+            eq_( whole, self._C( m, 3 ).tolist() )
+
+class TestSimilaritySplit(Base):
+    functionname = 'similarity_split'
+
+    def test_groups_similar_rows( self ):
+        m = store_rows( ['AAAA', 'CCCC', 'AAAT', 'CCCA', 'AATA', 'CCAC'] )
+        eq_( [[0, 2, 4], [1, 3, 5]], self._C( m, 2 ) )
+
+    def test_sizes_are_balanced( self ):
+        # 7 near identical sequences and 1 outlier still split 4/4
+        m = store_rows( ['AAAA'] * 7 + ['CCCC'] )
+        eq_( [4, 4], sorted(len(c) for c in self._C( m, 2 )) )
+        eq_( [3, 3, 2], [len(c) for c in self._C( m, 3 )] )
+        # Always the asked for number of chunks
+        m = store_rows( ['AAAA'] * 10 )
+        eq_( [3, 3, 2, 2], [len(c) for c in self._C( m, 4 )] )
+
+    def test_every_row_once( self ):
+        rand = random.Random(1)
+        residues = [
+            ''.join(rand.choice('ACGT') for i in range(50)) for j in range(23)
+        ]
+        chunks = self._C( store_rows(residues), 4 )
+        eq_( range(23), sorted(sum(chunks, [])) )
+        eq_( [6, 6, 6, 5], [len(c) for c in chunks] )
+
+    def test_more_chunks_than_rows( self ):
+        eq_( [[0], [1]], self._C( store_rows(['AA', 'CC']), 5 ) )
+        eq_( [], self._C( store_rows([]), 2 ) )
+
+class TestAlignmentStore(BaseTempDir):
+    def _store( self, ids, residues ):
+        from whip.alignment import AlignmentStore
+        return AlignmentStore.from_residues( ids, residues )
+
+    def test_pads_rows( self ):
+        s = self._store( ['a', 'b'], ['ACGT', 'AC'] )
+        eq_( 2, len(s) )
+        eq_( ['a', 'b'], s.ids.tolist() )
+        eq_( 'AC--', s.matrix[1].tostring() )
+        eq_( [4, 2], s.lengths.tolist() )
+
+    def test_costs_ignore_padding_and_gaps( self ):
+        s = self._store( ['a', 'b', 'c'], ['AC-T', 'A?', 'ACGT'] )
+        eq_( [3, 1, 4], s.costs().tolist() )
+
+    def test_costs_in_blocks( self ):
+        rand = random.Random(1)
+        residues = [
+            ''.join(rand.choice('ACGT-?') for i in range(rand.randint(1, 40)))
+            for j in range(25)
+        ]
+        s = self._store( range(25), residues )
+        # 3 rows of 40 columns per block
+        with patch('whip.alignment.HAMMING_BLOCK_CELLS', 120):
+            eq_(
+                [len(r) - r.count('-') - r.count('?') for r in residues],
+                s.costs().tolist()
+            )
+
+    def test_rows_cut_to_shortest( self ):
+        s = self._store( ['a', 'b'], ['ACGT', 'AC'] )
+        eq_( (2, 2), s.rows().shape )
+        eq_( 'uint8', str(s.rows().dtype) )
+        eq_( (0, 0), self._store( [], [] ).rows().shape )
+
+    def test_site_patterns_of_rows( self ):
+        s = self._store( ['a', 'b', 'c'], ['AAAT', 'CCCT', 'AAGA'] )
+        eq_( 2, s.site_patterns( [0, 1] ) )
+        eq_( 3, s.site_patterns( [0, 2] ) )
+        eq_( 3, s.site_patterns() )
+
+    def test_matches_xml_costs( self ):
+        from whip.alignment import AlignmentStore
+        from whip.xmlsplitter import sequence_cost
+        sequences = etree.parse( self.beastfiles[0] ).xpath( 'alignment/sequence' )
+        s = AlignmentStore.from_sequences( sequences )
+        eq_( [sequence_cost(seq) for seq in sequences], s.costs().tolist() )
+        eq_( sequences[0].find('taxon').get('idref'), s.ids[0] )
+
+    def test_save_and_load_memory_mapped( self ):
+        from whip.alignment import AlignmentStore
+        s = self._store( ['a', 'b'], ['ACGT', 'AC'] )
+        s.save( 'store' )
+        l = AlignmentStore.load( 'store' )
+        ok_( isinstance(l.matrix, numpy.memmap) )
+        eq_( s.matrix.tolist(), l.matrix.tolist() )
+        eq_( s.costs().tolist(), l.costs().tolist() )
+        eq_( ['a', 'b'], l.ids.tolist() )
+        ok_( not isinstance(AlignmentStore.load( 'store', mmap=False ).matrix, numpy.memmap) )
@@ -95,6 +95,107 @@ class TestEstimateBeastRuntime(Base,BaseTempDir):
             contents = sout.getvalue()
             ok_( 'Beast did not exit correctly' in contents )
 
+class TestBuildProbeXml(Base,BaseTempDir):
+    functionname = 'build_probe_xml'
+
+    def test_shortens_chain_and_silences_logs( self ):
+        with open(self.beastfiles[0]) as fh:
+            self._writexmlfile( fh.read().replace('overwrite="true"', 'overwrite="false"'), 'input.xml' )
+        r = self._C( 'input.xml', 'probe.xml', logevery=100, rows=50 )
+        eq_( 'probe.xml', r )
+        xml = etree.parse( 'probe.xml' )
+        eq_( '5000', xml.find('.//mcmc').attrib['chainLength'] )
+        eq_( '100', xml.find('.//log[@id="screenLog"]').attrib['logEvery'] )
+        filelog = xml.find('.//log[@id="fileLog"]')
+        eq_( os.devnull, filelog.attrib['fileName'] )
+        eq_( 'true', filelog.attrib['overwrite'] )
+        # File loggers keep their own frequency
+        eq_( '1000', filelog.attrib['logEvery'] )
+        eq_( os.devnull, xml.find('.//logTree').attrib['fileName'] )
+
+    def test_keeps_shorter_chain( self ):
+        self._C( self.beastfiles[0], 'probe.xml', logevery=1000, rows=1000 )
+        xml = etree.parse( 'probe.xml' )
+        eq_( '100000', xml.find('.//mcmc').attrib['chainLength'] )
+
+    def test_extrapolates_with_original_chainlength( self ):
+        from whip.beagleoptimiser import estimate_beast_runtime
+        with patch( 'whip.beagleoptimiser.Popen', self.mock_beast(6.5) ) as p:
+            r = estimate_beast_runtime( self.beastfiles[2], 999, StringIO(), probe=True )
+        # benchmark2.xml has a chainLength of 1000000
+        assert_almost_equal( 6.5, r )
+        cmd = p.call_args[0][0]
+        eq_( 'probe.xml', basename(cmd[-1]) )
+        # Probe is written into the temp directory which is cleaned up
+        ok_( not exists(cmd[-1]) )
+
+class TestSampleBeastRuntime(Base,BaseTempDir):
+    functionname = 'sample_beast_runtime'
+
+    def _beast( self, readings ):
+        lines = ['BEAST v1.10.4', 'state    Posterior']
+        for i, hpm in enumerate(readings):
+            lines.append( '{0}0000\t-85760.1\t{1} hours/million states'.format(i, hpm) )
+        beast = self._fake_popen( '\n'.join(lines), '', 0 )
+        beast.return_value.returncode = 0
+        return beast
+
+    def _run( self, readings, *args, **kwargs ):
+        with patch('whip.beagleoptimiser.Popen', self._beast(readings)) as p:
+            r = self._C( self.beastfiles[0], 999, StringIO(), *args, **kwargs )
+        return r, p
+
+    def test_discards_warmup_and_takes_samples( self ):
+        r, p = self._run( [9.0, 1.0, 2.0, 3.0, 4.0, 5.0], samples=3, discard=1 )
+        eq_( [1.0, 2.0, 3.0], r.samples )
+        # beast.xml is 100000 states
+        assert_almost_equal( 0.2, r.hours )
+        ok_( r.lower < r.hours < r.upper )
+        ok_( p.return_value.kill.called )
+
+    def test_uses_last_reading_if_only_warmup( self ):
+        r, p = self._run( [9.0], samples=3, discard=1 )
+        eq_( [9.0], r.samples )
+        eq_( float('inf'), r.upper )
+
+    def test_stops_early_when_clearly_slower( self ):
+        r, p = self._run( [9.0, 5.0, 5.01, 5.0, 5.01, 5.0], samples=5,
+            stop_above=0.1 )
+        eq_( 2, len(r.samples) )
+
+    def test_stops_after_maxtime( self ):
+        with patch('whip.beagleoptimiser.time') as t:
+            t.time.side_effect = [0, 0, 100]
+            r, p = self._run( [9.0, 1.0, 2.0, 3.0], samples=3, maxtime=10 )
+        eq_( [1.0], r.samples )
+
+    @raises(ValueError)
+    def test_raises_without_readings( self ):
+        self._run( [] )
+
+class TestSummarizeSamples(BeastBase):
+    def _C( self, *args, **kwargs ):
+        from whip.beagleoptimiser import summarize_samples
+        return summarize_samples( *args, **kwargs )
+
+    def test_confidence_interval( self ):
+        r = self._C( [1.0, 2.0, 3.0], 2000000 )
+        assert_almost_equal( 4.0, r.hours )
+        # t(2) = 4.303, sd = 1, n = 3
+        half = 4.303 / 3 ** 0.5 * 2
+        assert_almost_equal( 4.0 + half, r.upper )
+        # Interval is clipped at 0 hours
+        eq_( 0.0, r.lower )
+
+    def test_large_sample_uses_normal( self ):
+        r = self._C( [1.0, 3.0] * 20, 1000000 )
+        half = 1.96 * (sum((x - 2.0) ** 2 for x in [1.0, 3.0] * 20) / 39 / 40) ** 0.5
+        assert_almost_equal( 2.0 + half, r.upper )
+
+    def test_single_sample_unbounded( self ):
+        r = self._C( [1.0], 1000000 )
+        eq_( (1.0, 0.0, float('inf'), [1.0]), r )
+
 class TestGetChainLength(BeastBase):
     def _C( self, *args, **kwargs ):
         from whip.beagleoptimiser import get_chainlength
@@ -373,6 +474,82 @@ class TestGetAvailableBeagleOptions(BeagleOptions):
             r = self._C()
             eq_( expected_options, r )
 
+class TestSmartBeagleOptions(BeagleOptions):
+    functionname = 'get_available_beagle_options'
+
+    def test_uses_instance_candidates( self ):
+        info = 'BEAGLE resources available:\n' + ''.join(self.resources[:3])
+        with patch('whip.beagleoptimiser.instance_candidates') as ic:
+            ic.return_value = [2, 8]
+            r = self._C( info, smart=True, patterns=4000, threads=True )
+        eq_( 4000, ic.call_args[1]['patterns'] )
+        eq_( [
+            '-beagle_GPU -beagle_order 1',
+            '-beagle_GPU -beagle_order 2',
+            '-beagle_GPU -beagle_instances 2',
+            '-beagle_GPU -beagle_instances 2 -beagle_order 1,2',
+            '-beagle_SSE',
+            '-beagle_SSE -beagle_instances 2',
+            '-beagle_SSE -beagle_instances 8',
+            '-beagle_SSE -beagle_threads 2',
+            '-beagle_SSE -beagle_threads 8',
+        ], r )
+
+class TestParseBeagleResources(BeagleOptions):
+    functionname = 'parse_beagle_resources'
+
+    def test_parses_resources( self ):
+        info = 'BEAST v1.10.4\n\nBEAGLE resources available:\n' + \
+            ''.join(self.resources[:2])
+        r = self._C( info )
+        eq_( [0, 1], [res.index for res in r] )
+        eq_( ['CPU', 'Graphics card'], [res.name for res in r] )
+        ok_( 'VECTOR_SSE' in r[0].flags )
+        ok_( 'PROCESSOR_CPU' in r[0].flags )
+        ok_( 'PROCESSOR_GPU' in r[1].flags )
+        ok_( 'VECTOR_SSE' not in r[1].flags )
+
+    def test_older_header( self ):
+        info = '--- BEAGLE RESOURCES ---\n' + self.resources[3]
+        r = self._C( info )
+        eq_( [(3, 'Graphics card 3')], [(res.index, res.name) for res in r] )
+
+    def test_gpu_named_cpu_is_gpu( self ):
+        r = self._C( self.resources[1].replace('Graphics card', 'CPU lookalike') )
+        ok_( 'PROCESSOR_GPU' in r[0].flags )
+
+class TestGetBeagleInfo(Base,BaseTempDir):
+    functionname = 'get_beagle_info'
+
+    def _popen( self, out ):
+        p = Mock()
+        p.communicate.return_value = (out, '')
+        p.returncode = 0
+        return Mock(return_value=p)
+
+    def test_reuses_cached_info_until_binaries_change( self ):
+        from whip.cache import BeagleInfoCache
+        cache = BeagleInfoCache( join(self.setupdir, 'bi.json') )
+        fingerprint = [['/bin/beast', 1.0]]
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.Popen', self._popen('info1')),
+                patch('whip.beagleoptimiser.beagle_fingerprint'),
+            ) as (p, fp):
+            fp.side_effect = lambda: fingerprint
+            eq_( 'info1', self._C( cache ) )
+            p.return_value.communicate.return_value = ('info2', '')
+            eq_( 'info1', self._C( cache ) )
+            eq_( 1, p.call_count )
+            fingerprint = [['/bin/beast', 2.0]]
+            eq_( 'info2', self._C( cache ) )
+            eq_( 2, p.call_count )
+
+    def test_no_cache_always_runs( self ):
+        with patch('whip.beagleoptimiser.Popen', self._popen('info')) as p:
+            self._C()
+            self._C()
+        eq_( 2, p.call_count )
+
 class TestGetGPUOptions(BeagleOptions,Base):
     functionname = 'get_gpu_options'
 
@@ -444,6 +621,11 @@ class TestGetGPUOptions(BeagleOptions,Base):
         print r
         eq_( expected, r )
 
+    def test_accepts_parsed_resources( self ):
+        from whip.beagleoptimiser import parse_beagle_resources
+        resources = parse_beagle_resources( ''.join(self.resources) )
+        eq_( self._C( self.resources ), self._C( resources ) )
+
 class TestRunBeastOptions(BeagleOptions, BaseTempDir, Base):
     functionname = 'run_beast_options'
 
@@ -575,6 +757,242 @@ class TestRunBeastOptions(BeagleOptions, BaseTempDir, Base):
             expected.sort( key=lambda x: x[1] )
             eq_( expected, r )
 
+    def test_runs_options_concurrently( self ):
+        from whip.beagleoptimiser import option_to_kwargs
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime')
+            ) as (p1, p2):
+            times = [random.random() for i in range(len(self.avail_options))]
+            # Runs finish out of order so look the time up by the options
+            bykwargs = dict(
+                (frozenset(option_to_kwargs(o)), t)
+                for o, t in zip(self.avail_options, times)
+            )
+            p1.return_value = self.avail_options
+            p2.side_effect = lambda xmlfile, seed, stream, probe, timeout, \
+                supervisor, **kw: bykwargs[frozenset(kw)]
+            r = self._C( self.beastfiles[0], jobs=3 )
+            expected = zip( self.avail_options, times )
+            expected.sort( key=lambda x: x[1] )
+            eq_( expected, r )
+
+    def test_uses_and_fills_cache( self ):
+        from whip.cache import EstimateCache
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+            ) as (p1, p2, p3):
+            p1.return_value = self.avail_options[3:5]
+            p2.side_effect = [0.5, ValueError]
+            p3.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            r1 = self._C( self.beastfiles[0], cache=cache )
+            # Only the failed option is rerun
+            p2.side_effect = [0.25]
+            stringstream = StringIO()
+            r2 = self._C( self.beastfiles[0], stream=stringstream, cache=cache )
+            eq_( [('-beagle_SSE', 0.5), ('-beagle_SSE -beagle_instances 2', sys.maxint)], r1 )
+            eq_( [('-beagle_SSE -beagle_instances 2', 0.25), ('-beagle_SSE', 0.5)], r2 )
+            ok_( '-beagle_SSE estimate: 00:30:00.0 (Cached)' in stringstream.getvalue() )
+            eq_( 3, p2.call_count )
+
+    def test_hashes_xml_once( self ):
+        from whip.cache import EstimateCache, file_hash
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+                patch('whip.beagleoptimiser.file_hash'),
+            ) as (p1, p2, p3, p4):
+            p1.return_value = self.avail_options[:4]
+            p2.return_value = 0.5
+            p3.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            p4.side_effect = file_hash
+            self._C( self.beastfiles[0], cache=cache )
+            eq_( 4, p2.call_count )
+            eq_( 1, p4.call_count )
+
+    def test_records_timed_out_options( self ):
+        from whip.beagleoptimiser import BeastTimeoutError
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+            ) as (p1, p2):
+            p1.return_value = self.avail_options[3:6]
+            p2.side_effect = [BeastTimeoutError(30.0), 0.5, ValueError]
+            stringstream = StringIO()
+            r = self._C( self.beastfiles[0], stream=stringstream, timeout=30 )
+        eq_( [
+            ('-beagle_SSE -beagle_instances 2', 0.5),
+            ('-beagle_SSE', sys.maxint),
+            ('-beagle_SSE -beagle_instances 4', sys.maxint),
+        ], r )
+        eq_( ['ok', 'timeout', 'error'], [run.status for run in r] )
+        ok_( r[1].elapsed is not None )
+        eq_( 30, p2.call_args[1]['timeout'] )
+        ok_( '-beagle_SSE timed out after' in stringstream.getvalue() )
+
+    def test_runs_record_metadata( self ):
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+            ) as (p1, p2):
+            p1.return_value = self.avail_options[3:4]
+            p2.return_value = 0.65
+            r = self._C( self.beastfiles[0], beagle_info='BEAST v1.10.4\n' )
+        run = r[0]
+        eq_( 'ok', run.status )
+        eq_( abspath(self.beastfiles[0]), run.xmlfile )
+        # beast.xml is 100000 states
+        assert_almost_equal( 6.5, run.samples[0] )
+        eq_( '1.10.4', run.beast_version )
+        ok_( run.fingerprint is not None )
+        ok_( run.host )
+        ok_( run.elapsed >= 0 )
+
+    def test_refresh_ignores_cache( self ):
+        from whip.cache import EstimateCache
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+            ) as (p1, p2, p3):
+            p1.return_value = self.avail_options[3:4]
+            p2.side_effect = [0.5, 0.75]
+            p3.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            self._C( self.beastfiles[0], cache=cache )
+            r = self._C( self.beastfiles[0], cache=cache, refresh=True )
+            eq_( [('-beagle_SSE', 0.75)], r )
+            eq_( 0.75, cache.entries.values()[0]['hours'] )
+
+    def test_probe_estimates_cached_apart( self ):
+        from whip.cache import EstimateCache
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+            ) as (p1, p2, p3):
+            p1.return_value = self.avail_options[3:4]
+            p2.side_effect = [0.5, 0.75]
+            p3.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            eq_( [('-beagle_SSE', 0.5)], self._C( self.beastfiles[0], cache=cache ) )
+            r = self._C( self.beastfiles[0], cache=cache, probe=True )
+            eq_( [('-beagle_SSE', 0.75)], r )
+            eq_( 'ok', r[0].status )
+            r = self._C( self.beastfiles[0], cache=cache, probe=True )
+            eq_( 'cached', r[0].status )
+            eq_( 0.75, r[0].hours )
+            r = self._C( self.beastfiles[0], cache=cache )
+            eq_( 0.5, r[0].hours )
+            eq_( 2, p2.call_count )
+
+    def test_cached_estimate_needs_enough_samples( self ):
+        from whip.cache import EstimateCache
+        from whip.beagleoptimiser import RuntimeEstimate
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.sample_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+            ) as (p1, p2, p3, p4):
+            p1.return_value = self.avail_options[3:4]
+            p2.return_value = 0.5
+            p3.return_value = RuntimeEstimate( 0.6, 0.5, 0.7, [0.6] * 4 )
+            p4.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            self._C( self.beastfiles[0], cache=cache )
+            # A single reading is not reused when 4 samples are asked for
+            r = self._C( self.beastfiles[0], cache=cache, samples=4 )
+            eq_( 'ok', r[0].status )
+            eq_( 0.6, r[0].hours )
+            eq_( 1, p3.call_count )
+            # but 4 readings are reused for fewer samples or a plain estimate
+            r = self._C( self.beastfiles[0], cache=cache, samples=2 )
+            eq_( 'cached', r[0].status )
+            r = self._C( self.beastfiles[0], cache=cache )
+            eq_( 'cached', r[0].status )
+            eq_( 1, p2.call_count )
+            eq_( 1, p3.call_count )
+
+    def test_samples_with_early_stopping( self ):
+        from whip.beagleoptimiser import RuntimeEstimate
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.sample_beast_runtime')
+            ) as (p1, p2):
+            p1.return_value = self.avail_options[3:5]
+            p2.side_effect = [
+                RuntimeEstimate( 1.0, 0.9, 1.1, [1.0, 1.0] ),
+                RuntimeEstimate( 2.0, 1.8, 2.2, [2.0, 2.0] ),
+            ]
+            stringstream = StringIO()
+            r = self._C( self.beastfiles[0], stream=stringstream, samples=4 )
+            eq_( [('-beagle_SSE', 1.0), ('-beagle_SSE -beagle_instances 2', 2.0)], r )
+            # Second option is told to stop once it is worse than the first
+            eq_( None, p2.call_args_list[0][1]['stop_above'] )
+            eq_( 1.1, p2.call_args_list[1][1]['stop_above'] )
+            eq_( 4, p2.call_args_list[1][1]['samples'] )
+            ok_( '-beagle_SSE estimate: 01:00:00.0 (95% CI 00:54:00.0 - 01:06:00.0 from 2 samples)' in stringstream.getvalue() )
+
+    def test_halving_strategy( self ):
+        from whip.beagleoptimiser import RuntimeEstimate
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.sample_beast_runtime')
+            ) as (p1, p2):
+            p1.return_value = self.avail_options[3:7]
+            speeds = {
+                '-beagle_instances 2': 2.0, '-beagle_instances 4': 1.0,
+                '-beagle_instances 6': 3.0,
+            }
+            def sample( xmlfile, seed, stream, samples, stop_above, probe,
+                    timeout, supervisor, **kw ):
+                hours = 4.0
+                for o in kw:
+                    hours = speeds.get(o, hours)
+                return RuntimeEstimate( hours, hours, hours, [hours] * samples )
+            p2.side_effect = sample
+            r = self._C( self.beastfiles[0], strategy='halving' )
+            eq_( [
+                ('-beagle_SSE -beagle_instances 4', 1.0),
+                ('-beagle_SSE -beagle_instances 2', 2.0),
+                ('-beagle_SSE -beagle_instances 6', 3.0),
+                ('-beagle_SSE', 4.0),
+            ], r )
+            # 4 options with 1 sample then 2 options with 2 samples
+            eq_( [1, 1, 1, 1, 2, 2], [c[1]['samples'] for c in p2.call_args_list] )
+
+    def test_halving_strategy_with_cache( self ):
+        from whip.beagleoptimiser import RuntimeEstimate
+        from whip.cache import EstimateCache
+        cache = EstimateCache( join(self.setupdir, 'est.jsonl') )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.sample_beast_runtime'),
+                patch('whip.beagleoptimiser.get_beagle_info'),
+            ) as (p1, p2, p3):
+            p1.return_value = self.avail_options[3:7]
+            p3.return_value = 'BEAST v1.10.4\n0 : CPU\n'
+            def sample( xmlfile, seed, stream, samples, stop_above, probe,
+                    timeout, supervisor, **kw ):
+                hours = 1.0 if '-beagle_instances' in kw else 4.0
+                return RuntimeEstimate( hours, hours, hours, [hours] * samples )
+            p2.side_effect = sample
+            r = self._C( self.beastfiles[0], strategy='halving', cache=cache )
+            # Survivors are rerun with more samples instead of being cached
+            eq_( [1, 1, 1, 1, 2, 2], [c[1]['samples'] for c in p2.call_args_list] )
+            eq_( ['ok', 'ok'], [run.status for run in r[:2]] )
+            eq_( [2, 2], [len(run.samples) for run in r[:2]] )
+            # Running again reuses every round from the cache
+            r = self._C( self.beastfiles[0], strategy='halving', cache=cache )
+            eq_( 6, p2.call_count )
+            eq_( ['cached', 'cached'], [run.status for run in r[:2]] )
+
     def test_handles_bad_beast_run_exception( self ):
         with contextlib.nested(
                 patch('whip.beagleoptimiser.get_available_beagle_options'),
@@ -590,3 +1008,452 @@ class TestRunBeastOptions(BeagleOptions, BaseTempDir, Base):
             expected = zip( self.avail_options, times )
             expected.sort( key=lambda x: x[1] )
             eq_( expected, r )
+
+class TestOptionResources(Base):
+    functionname = 'option_resources'
+
+    def test_instances_are_cpus( self ):
+        eq_( (4, False), self._C( '-beagle_SSE -beagle_instances 4' ) )
+
+    def test_defaults_to_one_cpu( self ):
+        eq_( (1, False), self._C( '-beagle_SSE' ) )
+
+    def test_gpu( self ):
+        eq_( (1, True), self._C( '-beagle_GPU -beagle_order 1' ) )
+        eq_( (2, True), self._C( '-beagle_GPU -beagle_instances 2' ) )
+
+    def test_threads_per_instance( self ):
+        eq_( (2, False), self._C( '-beagle_SSE -beagle_threads 2' ) )
+        eq_( (8, False), self._C( '-beagle_SSE -beagle_instances 4 -beagle_threads 2' ) )
+
+class TestOptionToKwargs(Base):
+    functionname = 'option_to_kwargs'
+
+    def test_keeps_values_with_flags( self ):
+        eq_( {'-beagle_SSE': True, '-beagle_instances 4': True},
+            self._C( '-beagle_SSE -beagle_instances 4' ) )
+
+    def test_many_flags( self ):
+        eq_( {'-beagle_GPU': True, '-beagle_instances 2': True,
+            '-beagle_order 1,2': True},
+            self._C( '-beagle_GPU -beagle_instances 2 -beagle_order 1,2' ) )
+
+class TestPhysicalCoreCount(Base,BaseTempDir):
+    functionname = 'physical_core_count'
+
+    def test_ignores_hyperthreads( self ):
+        with open('cpuinfo', 'w') as fh:
+            for physical in range(2):
+                for core in range(4):
+                    # Two hyperthreads per core
+                    for ht in range(2):
+                        fh.write( 'processor\t: x\nphysical id\t: {0}\n'
+                            'core id\t\t: {1}\n\n'.format(physical, core) )
+        eq_( 8, self._C( 'cpuinfo' ) )
+
+    def test_falls_back_to_cpu_count( self ):
+        eq_( multiprocessing.cpu_count(), self._C( 'missing' ) )
+
+class TestNumaNodeCount(Base,BaseTempDir):
+    functionname = 'numa_node_count'
+
+    def test_counts_nodes( self ):
+        for d in ('node0', 'node1', 'possible'):
+            os.mkdir( d )
+        eq_( 2, self._C( '.' ) )
+
+    def test_defaults_to_one( self ):
+        eq_( 1, self._C( 'missing' ) )
+
+class TestInstanceCandidates(Base):
+    functionname = 'instance_candidates'
+
+    def test_powers_of_two_and_cores( self ):
+        eq_( [2, 4, 8, 16, 24], self._C( cores=24, numa=1 ) )
+
+    def test_numa_layout( self ):
+        eq_( [2, 4, 8, 12, 16, 24], self._C( cores=24, numa=2 ) )
+
+    def test_few_patterns_limit_instances( self ):
+        eq_( [2, 4], self._C( cores=64, numa=1, patterns=2500 ) )
+        eq_( [], self._C( cores=64, numa=1, patterns=100 ) )
+
+    def test_single_core( self ):
+        eq_( [], self._C( cores=1, numa=1 ) )
+
+class TestScheduleOptions(Base):
+    functionname = 'schedule_options'
+
+    def _tracking_run( self ):
+        ''' run function that records which options were running together '''
+        lock = threading.Lock()
+        running = []
+        self.overlaps = []
+        def run( option ):
+            with lock:
+                running.append( option )
+                self.overlaps.append( list(running) )
+            time.sleep(0.05)
+            with lock:
+                running.remove( option )
+            return option.upper()
+        return run
+
+    def test_results_in_option_order( self ):
+        options = ['-a', '-b', '-c', '-d']
+        r = self._C( options, self._tracking_run(), jobs=4, cpus=4 )
+        eq_( ['-A', '-B', '-C', '-D'], r )
+        ok_( max(len(o) for o in self.overlaps) > 1 )
+
+    def test_single_job_is_serial( self ):
+        options = ['-a', '-b', '-c']
+        self._C( options, self._tracking_run(), jobs=1, cpus=4 )
+        eq_( 1, max(len(o) for o in self.overlaps) )
+
+    def test_instances_never_exceed_cpus( self ):
+        from whip.beagleoptimiser import option_resources
+        options = [
+            '-beagle_SSE -beagle_instances 4',
+            '-beagle_SSE -beagle_instances 2',
+            '-beagle_SSE -beagle_instances 6',
+            '-beagle_SSE',
+            '-beagle_SSE -beagle_instances 8',
+        ]
+        self._C( options, self._tracking_run(), jobs=8, cpus=6 )
+        for running in self.overlaps:
+            cpus = sum(option_resources(o)[0] for o in running)
+            # An option larger than cpus is only allowed to run alone
+            ok_( cpus <= 6 or len(running) == 1 )
+
+    def test_one_gpu_option_at_a_time( self ):
+        options = [
+            '-beagle_GPU -beagle_order 1',
+            '-beagle_GPU -beagle_order 2',
+            '-beagle_SSE',
+        ]
+        self._C( options, self._tracking_run(), jobs=3, cpus=8 )
+        for running in self.overlaps:
+            ok_( len([o for o in running if 'GPU' in o]) <= 1 )
+        # SSE option should still run alongside a GPU option
+        ok_( max(len(o) for o in self.overlaps) == 2 )
+
+    def test_custom_resources( self ):
+        tasks = [('a.xml', '-beagle_GPU'), ('b.xml', '-beagle_GPU')]
+        r = self._C( tasks, lambda t: t[0], jobs=2, cpus=4,
+            resources=lambda t: (1, True) )
+        eq_( ['a.xml', 'b.xml'], r )
+
+    @raises(KeyError)
+    def test_reraises_run_errors( self ):
+        def run( option ):
+            raise KeyError( option )
+        self._C( ['-a', '-b'], run, jobs=2, cpus=2 )
+
+class TestSuccessiveHalving(Base):
+    functionname = 'successive_halving'
+
+    def test_keeps_faster_half_each_round( self ):
+        speeds = dict( ('-o{0}'.format(i), float(i)) for i in range(1, 8) )
+        calls = []
+        def run( option, nsamples ):
+            calls.append( (option, nsamples) )
+            return (option, speeds[option])
+        r = self._C( sorted(speeds, reverse=True), run, samples=2, stream=StringIO() )
+        eq_( [('-o{0}'.format(i), float(i)) for i in range(1, 8)], r )
+        rounds = {}
+        for option, nsamples in calls:
+            rounds.setdefault( nsamples, [] ).append( option )
+        # 7 options, then the best 3 after which only 1 is kept
+        eq_( {2: 7, 4: 3}, dict((k, len(v)) for k, v in rounds.items()) )
+        eq_( ['-o1','-o2','-o3'], sorted(rounds[4]) )
+
+    def test_single_option( self ):
+        r = self._C( ['-a'], lambda o, n: (o, 1.0), stream=StringIO() )
+        eq_( [('-a', 1.0)], r )
+
+class TestBeastProcess(Base,BaseTempDir):
+    def _process( self, cmd, timeout=None ):
+        from whip.beagleoptimiser import BeastProcess
+        return BeastProcess( cmd, '.', timeout )
+
+    def test_reads_stdout_and_stderr( self ):
+        p = self._process(
+            ['sh', '-c', 'echo out1; echo err >&2; echo out2; exit 3']
+        )
+        eq_( ['out1\n', 'out2\n'], list(p.lines()) )
+        eq_( 3, p.wait() )
+        eq_( 'err\n', p.error_output() )
+
+    def test_timeout_kills_beast( self ):
+        from whip.beagleoptimiser import BeastTimeoutError
+        p = self._process( ['sh', '-c', 'echo start; sleep 30'], timeout=0.5 )
+        lines = []
+        try:
+            for line in p.lines():
+                lines.append( line )
+            ok_( False, 'Did not time out' )
+        except BeastTimeoutError as e:
+            ok_( e.elapsed >= 0.5 )
+        eq_( ['start\n'], lines )
+        ok_( p.process.returncode is not None )
+
+    def test_kill_takes_children_with_it( self ):
+        p = self._process( ['sh', '-c', 'sleep 30 & echo $!; wait'] )
+        child = int(next(p.lines()))
+        p.kill()
+        # Child is reparented and reaped by init once killed
+        for i in range(50):
+            try:
+                os.kill( child, 0 )
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            ok_( False, 'Child of beast is still running' )
+
+    def test_kill_after_exit_sends_nothing( self ):
+        p = self._process( ['true'] )
+        eq_( 0, p.wait() )
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.os.killpg'),
+                patch.object(p.process, 'kill'),
+            ) as (killpg, kill):
+            p.kill()
+            p.kill()
+        ok_( not killpg.called )
+        ok_( not kill.called )
+
+class TestBeastSupervisor(Base,BaseTempDir):
+    def test_cancel_kills_running_and_refuses_new( self ):
+        from whip.beagleoptimiser import BeastSupervisor
+        s = BeastSupervisor()
+        p1 = s.launch( ['sleep', '30'], '.' )
+        p2 = s.launch( ['sleep', '30'], '.' )
+        start = time.time()
+        s.cancel()
+        ok_( time.time() - start < 10 )
+        ok_( p1.process.returncode is not None )
+        ok_( p2.process.returncode is not None )
+        try:
+            s.launch( ['true'], '.' )
+            ok_( False, 'Launched after cancel' )
+        except ValueError:
+            pass
+
+    def test_finished_stops_tracking( self ):
+        from whip.beagleoptimiser import BeastSupervisor
+        s = BeastSupervisor()
+        p = s.launch( ['true'], '.' )
+        p.wait()
+        s.finished( p )
+        eq_( set(), s.running )
+
+class TestReadHoursPerMillion(Base,BaseTempDir):
+    functionname = 'read_hours_per_million'
+
+    def test_timeout_raises_and_cleans_up( self ):
+        from whip.beagleoptimiser import BeastTimeoutError, BeastSupervisor
+        supervisor = BeastSupervisor()
+        beast = self._fake_popen( 'BEAST v1.10.4\nstate', '', 0.6 )
+        with patch( 'whip.beagleoptimiser.Popen', beast ):
+            try:
+                self._C( self.beastfiles[0], 999, StringIO(), lambda r: True,
+                    timeout=0.5, supervisor=supervisor )
+                ok_( False, 'Did not time out' )
+            except BeastTimeoutError:
+                pass
+        ok_( beast.return_value.kill.called )
+        eq_( set(), supervisor.running )
+
+    def test_removes_tempdir_after_timeout( self ):
+        from whip.beagleoptimiser import BeastTimeoutError
+        import tempfile
+        tdirs = []
+        real_mkdtemp = tempfile.mkdtemp
+        def mkdtemp( *args, **kwargs ):
+            tdirs.append( real_mkdtemp( dir=self.setupdir, *args, **kwargs ) )
+            return tdirs[-1]
+        beast = self._fake_popen( 'BEAST v1.10.4\nstate', '', 0.6 )
+        with patch( 'whip.beagleoptimiser.Popen', beast ):
+            with patch( 'whip.beagleoptimiser.tempfile.mkdtemp', mkdtemp ):
+                try:
+                    self._C( self.beastfiles[0], 999, StringIO(),
+                        lambda r: True, timeout=0.5 )
+                    ok_( False, 'Did not time out' )
+                except BeastTimeoutError:
+                    pass
+        eq_( 1, len(tdirs) )
+        ok_( not exists( tdirs[0] ) )
+
+class TestSplitInstances(Base):
+    functionname = 'split_instances'
+
+    def test_with_instances( self ):
+        eq_( ('-beagle_SSE', 4), self._C( '-beagle_SSE -beagle_instances 4' ) )
+        eq_( ('-beagle_GPU -beagle_order 1,2', 2),
+            self._C( '-beagle_GPU -beagle_instances 2 -beagle_order 1,2' ) )
+
+    def test_without_instances( self ):
+        eq_( ('-beagle_SSE', 1), self._C( '-beagle_SSE' ) )
+
+class TestFitScalingCurve(Base):
+    functionname = 'fit_scaling_curve'
+
+    def test_recovers_curve( self ):
+        curve = lambda n: 0.5 + 8.0/n + 0.125*n
+        a, b, c = self._C( [(n, curve(n)) for n in (1, 2, 4, 8, 16)] )
+        assert_almost_equal( 0.5, a )
+        assert_almost_equal( 8.0, b )
+        assert_almost_equal( 0.125, c )
+
+    @raises(ValueError)
+    def test_needs_three_counts( self ):
+        self._C( [(1, 2.0), (2, 1.5), (2, 1.4)] )
+
+class TestPredictBestInstances(Base):
+    functionname = 'predict_best_instances'
+
+    def test_nearest_count_to_optimum( self ):
+        # Optimum at sqrt(8/0.125) = 8
+        eq_( 8, self._C( (0.5, 8.0, 0.125), [1, 2, 4, 6, 8, 10, 12] ) )
+
+    def test_no_overhead_picks_most( self ):
+        eq_( 12, self._C( (0.5, 8.0, 0.0), [1, 2, 12] ) )
+
+class TestModelSearch(Base):
+    functionname = 'model_search'
+
+    def test_runs_few_counts( self ):
+        curve = lambda n: 0.5 + 8.0/n + 0.125*n
+        options = ['-beagle_SSE'] + \
+            ['-beagle_SSE -beagle_instances {0}'.format(n) for n in range(2, 33, 2)] + \
+            ['-beagle_GPU']
+        from whip.beagleoptimiser import split_instances
+        ran = []
+        def run( option ):
+            ran.append( option )
+            if 'GPU' in option:
+                return (option, 0.1)
+            return (option, curve(split_instances(option)[1]))
+        r = self._C( options, run, stream=StringIO() )
+        # 1, 6(nearest the geometric middle) and 32 then 8 with 6 and 10 around it
+        eq_( sorted([
+            '-beagle_GPU', '-beagle_SSE', '-beagle_SSE -beagle_instances 6',
+            '-beagle_SSE -beagle_instances 32', '-beagle_SSE -beagle_instances 8',
+            '-beagle_SSE -beagle_instances 10',
+        ]), sorted(ran) )
+        eq_( ('-beagle_GPU', 0.1), r[0] )
+        eq_( ('-beagle_SSE -beagle_instances 8', curve(8)), r[1] )
+
+    def test_small_groups_run_completely( self ):
+        options = ['-beagle_SSE', '-beagle_SSE -beagle_instances 2']
+        r = self._C( options, lambda o: (o, len(o)), stream=StringIO() )
+        eq_( options, [o for o, h in r] )
+
+class TestBeastRun(Base):
+    def _run( self, hours=1.5 ):
+        from whip.beagleoptimiser import BeastRun
+        return BeastRun( '-beagle_SSE', hours, 'ok', 12.0, [3.0, 4.0],
+            'in.xml', 'node1', 'abc', '1.10.4' )
+
+    def test_is_option_hours_tuple( self ):
+        run = self._run()
+        eq_( ('-beagle_SSE', 1.5), run )
+        eq_( ('-beagle_SSE', 1.5), (run.option, run.hours) )
+
+    def test_as_dict( self ):
+        d = self._run().as_dict()
+        eq_( [3.0, 4.0], d['samples'] )
+        eq_( 'node1', d['host'] )
+        eq_( None, self._run( sys.maxint ).as_dict()['hours'] )
+
+class TestWriteRuns(Base):
+    def setUp( self ):
+        super(TestWriteRuns,self).setUp()
+        from whip.beagleoptimiser import BeastRun
+        self.runs = [
+            BeastRun( '-beagle_SSE', 1.5, 'ok', 12.0, [3.0, 4.0], 'in.xml' ),
+            BeastRun( '-beagle_GPU', sys.maxint, 'timeout', 60.0 ),
+        ]
+
+    def test_json( self ):
+        import json
+        from whip.beagleoptimiser import write_runs_json
+        fh = StringIO()
+        write_runs_json( self.runs, fh )
+        r = json.loads( fh.getvalue() )
+        eq_( 2, len(r) )
+        eq_( 1.5, r[0]['hours'] )
+        eq_( [3.0, 4.0], r[0]['samples'] )
+        eq_( 'timeout', r[1]['status'] )
+        eq_( None, r[1]['hours'] )
+
+    def test_csv( self ):
+        import csv
+        from whip.beagleoptimiser import write_runs_csv, RUN_FIELDS
+        fh = StringIO()
+        write_runs_csv( self.runs, fh )
+        rows = list( csv.DictReader( StringIO(fh.getvalue()) ) )
+        eq_( list(RUN_FIELDS), csv.DictReader(StringIO(fh.getvalue())).fieldnames )
+        eq_( '3.0;4.0', rows[0]['samples'] )
+        eq_( '', rows[1]['hours'] )
+        eq_( '60.0', rows[1]['elapsed'] )
+
+class TestRunBeastBatch(BeagleOptions, BaseTempDir, Base):
+    functionname = 'run_beast_batch'
+
+    def test_one_pool_for_all_files( self ):
+        hours = {
+            (abspath(self.beastfiles[0]), '-beagle_SSE'): 2.0,
+            (abspath(self.beastfiles[0]), '-beagle_SSE -beagle_instances 2'): 1.0,
+            (abspath(self.beastfiles[2]), '-beagle_SSE'): 3.0,
+            (abspath(self.beastfiles[2]), '-beagle_SSE -beagle_instances 2'): 4.0,
+        }
+        options = ['-beagle_SSE', '-beagle_SSE -beagle_instances 2']
+        from whip.beagleoptimiser import option_to_kwargs, schedule_options
+        def estimate( xmlfile, seed, stream, probe, timeout, supervisor, **kw ):
+            for option in options:
+                if option_to_kwargs(option) == kw:
+                    return hours[(abspath(xmlfile), option)]
+        with contextlib.nested(
+                patch('whip.beagleoptimiser.get_beagle_info'),
+                patch('whip.beagleoptimiser.get_available_beagle_options'),
+                patch('whip.beagleoptimiser.estimate_beast_runtime'),
+                patch('whip.beagleoptimiser.schedule_options'),
+            ) as (p1, p2, p3, p4):
+            p1.return_value = 'BEAST v1.10.4\n'
+            p2.return_value = options
+            p3.side_effect = estimate
+            p4.side_effect = schedule_options
+            r = self._C( [self.beastfiles[0], self.beastfiles[2]], jobs=2 )
+        # Resources detected once and one pool for every file
+        eq_( 1, p1.call_count )
+        eq_( 1, p4.call_count )
+        eq_( 4, len(p4.call_args[0][0]) )
+        first, second = abspath(self.beastfiles[0]), abspath(self.beastfiles[2])
+        eq_( [(first, 1.0), (first, 2.0), (second, 3.0), (second, 4.0)],
+            [(run.xmlfile, run.hours) for run in r] )
+
+class TestWriteRanking(Base):
+    functionname = 'write_ranking'
+
+    def test_ranks_each_xml_and_lists_best( self ):
+        from whip.beagleoptimiser import BeastRun
+        runs = [
+            BeastRun( '-beagle_SSE', 2.0, xmlfile='a.xml' ),
+            BeastRun( '-beagle_GPU', sys.maxint, 'timeout', 3600.0, xmlfile='a.xml' ),
+            BeastRun( '-beagle_SSE', 1.0, xmlfile='b.xml' ),
+        ]
+        out = StringIO()
+        self._C( runs, out )
+        eq_( [
+            'Results sorted by estimated runtime:',
+            'a.xml',
+            '\t-beagle_SSE estimated to take 02:00:00.0',
+            '\t-beagle_GPU timed out after 01:00:00.0',
+            'b.xml',
+            '\t-beagle_SSE estimated to take 01:00:00.0',
+            'Best option for each xml:',
+            '\ta.xml: -beagle_SSE 02:00:00.0',
+            '\tb.xml: -beagle_SSE 01:00:00.0',
+        ], out.getvalue().splitlines() )
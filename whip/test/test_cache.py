@@ -0,0 +1,213 @@
+from common import *
+
+class Base(BaseTester):
+    modulepath = 'whip.cache'
+
+class TestCacheDir(Base):
+    functionname = 'cache_dir'
+
+    def test_uses_environment( self ):
+        with patch.dict(os.environ, {'BEAST_WHIP_CACHE': '/some/where'}):
+            eq_( '/some/where', self._C() )
+
+    def test_defaults_to_home( self ):
+        env = dict(os.environ)
+        env.pop('BEAST_WHIP_CACHE', None)
+        with patch.dict(os.environ, env, clear=True):
+            eq_( join(expanduser('~'), '.cache', 'beast_whip'), self._C() )
+
+class TestBeastVersion(Base):
+    functionname = 'beast_version'
+
+    def test_parses_banner( self ):
+        eq_( '1.10.4', self._C( 'BEAST v1.10.4, 2002-2018\nBEAGLE resources' ) )
+
+    def test_missing_banner( self ):
+        eq_( None, self._C( 'BEAGLE resources available:\n' ) )
+
+class TestEstimateKey(Base,BaseTempDir):
+    functionname = 'estimate_key'
+
+    def setUp( self ):
+        super(TestEstimateKey,self).setUp()
+        from whip.cache import file_hash
+        with open('input.xml', 'w') as fh:
+            fh.write('<beast/>')
+        self.xmlhash = file_hash('input.xml')
+        self.info = 'BEAST v1.10.4\n0 : CPU\n'
+
+    def test_same_inputs_same_key( self ):
+        eq_( self._C(self.xmlhash, self.info, '-beagle_SSE'),
+            self._C(self.xmlhash, self.info, '-beagle_SSE') )
+
+    def test_key_changes_with_each_input( self ):
+        from whip.cache import file_hash
+        key = self._C( self.xmlhash, self.info, '-beagle_SSE' )
+        ok_( key != self._C(self.xmlhash, self.info, '-beagle_CPU') )
+        ok_( key != self._C(self.xmlhash, 'BEAST v1.8.0\n0 : CPU\n', '-beagle_SSE') )
+        with patch('whip.cache.socket.gethostname', Mock(return_value='other')):
+            ok_( key != self._C(self.xmlhash, self.info, '-beagle_SSE') )
+        ok_( key != self._C(self.xmlhash, self.info, '-beagle_SSE', 'probe') )
+        with open('input.xml', 'w') as fh:
+            fh.write('<beast></beast>')
+        ok_( key != self._C(file_hash('input.xml'), self.info, '-beagle_SSE') )
+
+class TestEstimateCache(BaseTempDir):
+    def _cache( self, **kwargs ):
+        from whip.cache import EstimateCache
+        return EstimateCache( join(self.setupdir, 'cache', 'est.jsonl'), **kwargs )
+
+    def test_missing_key( self ):
+        eq_( None, self._cache().get('nope') )
+
+    def test_persists_between_instances( self ):
+        self._cache().put( 'k', 1.5, option='-beagle_SSE' )
+        entry = self._cache().get( 'k' )
+        eq_( 1.5, entry['hours'] )
+        eq_( '-beagle_SSE', entry['option'] )
+
+    def test_expired_entries_ignored_and_dropped( self ):
+        cache = self._cache( ttl=10 )
+        with patch('whip.cache.time.time', Mock(return_value=100.0)):
+            cache.put( 'old', 1.0 )
+        with patch('whip.cache.time.time', Mock(return_value=200.0)):
+            eq_( None, cache.get('old') )
+            cache.put( 'new', 2.0 )
+        with open(cache.path) as fh:
+            eq_( 1, len(fh.readlines()) )
+
+    def test_keeps_newest_maxentries( self ):
+        cache = self._cache( maxentries=2 )
+        for i, key in enumerate(('a', 'b', 'c')):
+            with patch('whip.cache.time.time', Mock(return_value=100.0 + i)):
+                cache.put( key, float(i) )
+        cache = self._cache( maxentries=2 )
+        eq_( ['b', 'c'], sorted(cache.entries) )
+
+    def test_instances_keep_each_others_entries( self ):
+        one = self._cache()
+        two = self._cache()
+        one.put( 'a', 1.0 )
+        two.put( 'b', 2.0 )
+        one.put( 'c', 3.0 )
+        cache = self._cache()
+        eq_( ['a', 'b', 'c'], sorted(cache.entries) )
+        eq_( 2.0, cache.get('b')['hours'] )
+
+    def test_keeps_newer_entry_on_merge( self ):
+        one = self._cache()
+        two = self._cache()
+        with patch('whip.cache.time.time', Mock(return_value=time.time() + 1)):
+            two.put( 'k', 2.0 )
+        one.put( 'other', 1.0 )
+        eq_( 2.0, one.get('k')['hours'] )
+
+    def test_skips_corrupt_lines( self ):
+        self._cache().put( 'k', 1.5 )
+        with open(join(self.setupdir, 'cache', 'est.jsonl'), 'a') as fh:
+            fh.write( '{"key": "broken' )
+        eq_( 1.5, self._cache().get('k')['hours'] )
+
+class TestBeagleInfoCache(BaseTempDir):
+    def _cache( self, host='host1' ):
+        from whip.cache import BeagleInfoCache
+        return BeagleInfoCache( join(self.setupdir, 'cache', 'bi.json'), host )
+
+    def test_missing( self ):
+        eq_( None, self._cache().get( [['beast', 1.0]] ) )
+
+    def test_matching_fingerprint( self ):
+        self._cache().put( [['beast', 1.0]], 'info' )
+        eq_( 'info', self._cache().get( [['beast', 1.0]] ) )
+
+    def test_changed_binary_invalidates( self ):
+        self._cache().put( [['beast', 1.0]], 'info' )
+        eq_( None, self._cache().get( [['beast', 2.0]] ) )
+
+    def test_per_host( self ):
+        self._cache('host1').put( [], 'one' )
+        self._cache('host2').put( [], 'two' )
+        eq_( 'one', self._cache('host1').get( [] ) )
+        eq_( 'two', self._cache('host2').get( [] ) )
+
+class TestPackedStrings(BaseTempDir):
+    def test_round_trip( self ):
+        from whip.cache import PackedStrings
+        PackedStrings.write( 'packed', ['<a/>', '', '<b>x</b>\n'] )
+        p = PackedStrings.load( 'packed' )
+        eq_( 3, len(p) )
+        eq_( ['<a/>', '', '<b>x</b>\n'], [p[i] for i in range(3)] )
+
+    def test_empty( self ):
+        from whip.cache import PackedStrings
+        PackedStrings.write( 'packed', [] )
+        eq_( 0, len(PackedStrings.load( 'packed' )) )
+
+class TestSplitCache(BaseTempDir):
+    def setUp( self ):
+        super(TestSplitCache,self).setUp()
+        from whip.alignment import AlignmentStore
+        self.store = AlignmentStore.from_residues( ['a', 'b'], ['AC', 'AG'] )
+        with open('input.xml', 'w') as fh:
+            fh.write( '<beast/>' )
+
+    def _cache( self, **kwargs ):
+        from whip.cache import SplitCache
+        return SplitCache( join(self.setupdir, 'cache', 'splits'), **kwargs )
+
+    def _put( self, xmlfile='input.xml', **kwargs ):
+        self._cache(**kwargs).put(
+            xmlfile, '<beast/>', ['<taxon id="a"/>', '<taxon id="b"/>'],
+            ['<sequence/>', '<sequence/>'], self.store
+        )
+
+    def test_missing( self ):
+        eq_( None, self._cache().get( 'input.xml' ) )
+
+    def test_round_trip( self ):
+        self._put()
+        template, taxa, sequences, store = self._cache().get( 'input.xml' )
+        eq_( '<beast/>', template )
+        eq_( '<taxon id="b"/>', taxa[1] )
+        eq_( 2, len(sequences) )
+        eq_( self.store.matrix.tolist(), store.matrix.tolist() )
+
+    def test_changed_file_is_stale( self ):
+        self._put()
+        st = os.stat( 'input.xml' )
+        os.utime( 'input.xml', (st.st_atime, st.st_mtime + 10) )
+        eq_( None, self._cache().get( 'input.xml' ) )
+        # Storing it again replaces the stale entry
+        self._put()
+        ok_( self._cache().get( 'input.xml' ) is not None )
+        eq_( 1, len(os.listdir( join(self.setupdir, 'cache', 'splits') )) )
+
+    def test_half_removed_entry_is_a_miss( self ):
+        self._put()
+        entry = os.listdir( join(self.setupdir, 'cache', 'splits') )[0]
+        shutil.rmtree( join(self.setupdir, 'cache', 'splits', entry, 'alignment') )
+        eq_( None, self._cache().get( 'input.xml' ) )
+
+    def test_drops_unused_entries( self ):
+        self._put()
+        splits = join(self.setupdir, 'cache', 'splits')
+        entry = os.listdir( splits )[0]
+        old = time.time() - 3600
+        os.utime( join(splits, entry, 'stamp.json'), (old, old) )
+        with open('other.xml', 'w') as fh:
+            fh.write( '<beast></beast>' )
+        self._put( 'other.xml', ttl=60 )
+        eq_( None, self._cache().get( 'input.xml' ) )
+        ok_( self._cache().get( 'other.xml' ) is not None )
+
+    def test_keeps_recently_used_within_maxbytes( self ):
+        self._put()
+        splits = join(self.setupdir, 'cache', 'splits')
+        old = time.time() - 3600
+        os.utime( join(splits, os.listdir(splits)[0], 'stamp.json'), (old, old) )
+        with open('other.xml', 'w') as fh:
+            fh.write( '<beast></beast>' )
+        # Room for one entry only so the least recently used one goes
+        self._put( 'other.xml', maxbytes=1500 )
+        eq_( None, self._cache().get( 'input.xml' ) )
+        ok_( self._cache().get( 'other.xml' ) is not None )
@@ -0,0 +1,76 @@
+from common import *
+
+from nose.plugins.skip import SkipTest
+
+class Base(BaseTester):
+    modulepath = 'whip.compression'
+
+class TestCompression(Base):
+    functionname = 'compression'
+
+    def test_by_extension( self ):
+        eq_( 'gz', self._C( 'a.xml.gz' ) )
+        eq_( 'xz', self._C( 'a.xml.xz' ) )
+        eq_( 'zst', self._C( 'a.xml.zst' ) )
+        eq_( None, self._C( 'a.xml' ) )
+
+class TestStripCompression(Base):
+    functionname = 'strip_compression'
+
+    def test_strips( self ):
+        eq_( 'dir/a.xml', self._C( 'dir/a.xml.gz' ) )
+        eq_( 'dir/a.xml', self._C( 'dir/a.xml' ) )
+
+class TestOpenFile(Base,BaseTempDir):
+    functionname = 'open_file'
+
+    def test_plain( self ):
+        with self._C( 'a.xml', 'w' ) as fh:
+            fh.write( '<beast/>' )
+        with open('a.xml') as fh:
+            eq_( '<beast/>', fh.read() )
+
+    def test_gzip_round_trip( self ):
+        import gzip
+        with self._C( 'a.xml.gz', 'w' ) as fh:
+            fh.write( '<beast/>' )
+        with contextlib.closing(gzip.open('a.xml.gz')) as fh:
+            eq_( '<beast/>', fh.read() )
+        with self._C( 'a.xml.gz' ) as fh:
+            eq_( '<beast/>', fh.read() )
+
+    def _round_trip( self, path ):
+        data = '<beast>' + 'ACGT' * 100000 + '</beast>'
+        with self._C( path, 'w' ) as fh:
+            fh.write( data[:10] )
+            fh.writelines( [data[10:]] )
+        ok_( os.path.getsize(path) < len(data) )
+        with self._C( path ) as fh:
+            eq_( data, fh.read() )
+        # lxml reads in blocks
+        with self._C( path ) as fh:
+            eq_( data, ''.join(iter(lambda: fh.read(4096), '')) )
+        with self._C( path ) as fh:
+            eq_( 'ACGT', etree.parse(fh).getroot().text[:4] )
+
+    def test_xz_round_trip( self ):
+        from whip import compression
+        if compression.lzma is None:
+            raise SkipTest( 'lzma is not installed' )
+        self._round_trip( 'a.xml.xz' )
+
+    def test_zst_round_trip( self ):
+        from whip import compression
+        if compression.zstandard is None:
+            raise SkipTest( 'zstandard is not installed' )
+        self._round_trip( 'a.xml.zst' )
+
+    @raises(ValueError)
+    def test_missing_lzma( self ):
+        with patch('whip.compression.lzma', None):
+            self._C( 'a.xml.xz', 'w' )
+
+    @raises(ValueError)
+    def test_missing_zstandard( self ):
+        with patch('whip.compression.zstandard', None):
+            self._C( 'a.xml.zst', 'w' )
@@ -0,0 +1,89 @@
+from common import *
+
+class Base(BaseTester):
+    modulepath = 'whip.launcher'
+
+FAKE_BEAST = '''#!/bin/sh
+echo "$@" > args
+echo "BEAST v1.10.4"
+echo "state    Posterior"
+echo "0    -146157.0"
+echo "50000    -92741.3    2.5 hours/million states"
+touch ran.log
+exit $(cat exitcode 2>/dev/null || echo 0)
+'''
+
+class TestProgress(Base):
+    def _progress( self ):
+        from whip.launcher import Progress
+        return Progress( 'out/split_1.xml', 1000000 )
+
+    def test_parses_screen_log( self ):
+        p = self._progress()
+        p.update( 'BEAST v1.10.4\n' )
+        eq_( 0, p.state )
+        eq_( None, p.remaining() )
+        p.update( '250000\t-85760.1\t2.0 hours/million states\n' )
+        eq_( 250000, p.state )
+        assert_almost_equal( 0.25, p.fraction() )
+        assert_almost_equal( 1.5, p.remaining() )
+
+    def test_str( self ):
+        p = self._progress()
+        eq_( 'split_1.xml waiting', str(p) )
+        p.status = 'running'
+        p.update( '500000\t-85760.1\t2.0 hours/million states\n' )
+        eq_( 'split_1.xml running 50% (500000/1000000 states) ETA 01:00:00.0', str(p) )
+
+class TestLaunchSplits(Base,BaseTempDir):
+    functionname = 'launch_splits'
+
+    def setUp( self ):
+        super(TestLaunchSplits,self).setUp()
+        os.mkdir( 'bin' )
+        with open('bin/beast', 'w') as fh:
+            fh.write( FAKE_BEAST )
+        os.chmod( 'bin/beast', 0755 )
+        self.env = patch.dict(
+            os.environ, {'PATH': abspath('bin') + os.pathsep + os.environ['PATH']}
+        )
+        self.env.start()
+        for i in (1, 2):
+            shutil.copy( self.beastfiles[0], 'split_{0}.xml'.format(i) )
+
+    def tearDown( self ):
+        self.env.stop()
+        super(TestLaunchSplits,self).tearDown()
+
+    def test_runs_each_file_in_own_directory( self ):
+        out = StringIO()
+        r = self._C( ['split_1.xml', 'split_2.xml'],
+            '-beagle_SSE -beagle_instances 2', 'runs', cpus=4, stream=out )
+        eq_( ['done', 'done'], [p.status for p in r] )
+        for i in (1, 2):
+            d = join( 'runs', 'split_{0}'.format(i) )
+            ok_( exists( join(d, 'ran.log') ) )
+            with open(join(d, 'args')) as fh:
+                eq_( '-beagle_SSE -beagle_instances 2 {0}'.format(
+                    abspath('split_{0}.xml'.format(i))), fh.read().strip() )
+            with open(join(d, 'beast.out')) as fh:
+                ok_( 'hours/million states' in fh.read() )
+        # beast.xml is 100000 states
+        eq_( 50000, r[0].state )
+        assert_almost_equal( 0.125, r[0].remaining() )
+        ok_( 'split_2.xml done' in out.getvalue() )
+
+    def test_reports_failures( self ):
+        os.makedirs( join('runs', 'split_2') )
+        with open(join('runs', 'split_2', 'exitcode'), 'w') as fh:
+            fh.write( '3' )
+        r = self._C( ['split_1.xml', 'split_2.xml'], '', 'runs', stream=StringIO() )
+        eq_( ['done', 'failed'], [p.status for p in r] )
+        eq_( 3, r[1].returncode )
+
+    def test_instances_limit_concurrency( self ):
+        with patch('whip.launcher.schedule_options') as s:
+            self._C( ['split_1.xml'], '-beagle_SSE -beagle_instances 4', cpus=8,
+                stream=StringIO() )
+        eq_( 8, s.call_args[1]['cpus'] )
+        eq_( (4, False), s.call_args[1]['resources']( None ) )
@@ -0,0 +1,108 @@
+from common import *
+
+class Base(BaseTester):
+    modulepath = 'whip.sweep'
+
+INFO = 'BEAST v1.10.4\n\nBEAGLE resources available:\n' \
+    '0 : CPU\n    Flags: PROCESSOR_CPU VECTOR_SSE\n\n\n'
+
+class TestHostClass(Base):
+    functionname = 'host_class'
+
+    def test_same_resources_same_class( self ):
+        eq_( self._C( INFO, 8 ), self._C( INFO, 8 ) )
+
+    def test_differs_by_cores_and_resources( self ):
+        c = self._C( INFO, 8 )
+        ok_( c != self._C( INFO, 16 ) )
+        gpu = INFO + '1 : Tesla\n    Flags: PROCESSOR_GPU\n'
+        ok_( c != self._C( gpu, 8 ) )
+
+class TestClaim(Base,BaseTempDir):
+    functionname = 'claim'
+
+    def test_only_first_claim_wins( self ):
+        ok_( self._C( 'lock' ) )
+        ok_( not self._C( 'lock' ) )
+
+    def test_takes_over_stale_claim( self ):
+        ok_( self._C( 'lock' ) )
+        old = time.time() - 100
+        os.utime( 'lock', (old, old) )
+        ok_( not self._C( 'lock', stale=1000 ) )
+        ok_( self._C( 'lock', stale=10 ) )
+
+class TestSweep(BaseTempDir):
+    def setUp( self ):
+        super(TestSweep,self).setUp()
+        from whip.sweep import init_queue
+        self.tasks = init_queue( 'queue', [self.beastfiles[0], self.beastfiles[2]] )
+        self.options = ['-beagle_SSE', '-beagle_SSE -beagle_instances 2']
+
+    def _work( self, host, cores, hours, stale=None ):
+        from whip.sweep import work
+        with contextlib.nested(
+                patch('whip.sweep.socket.gethostname', Mock(return_value=host)),
+                patch('whip.sweep.physical_core_count', Mock(return_value=cores)),
+                patch('whip.sweep.get_available_beagle_options',
+                    Mock(return_value=self.options)),
+                patch('whip.sweep.estimate_beast_runtime'),
+            ) as (h, c, o, e):
+            e.side_effect = hours
+            return work( 'queue', StringIO(), INFO, stale=stale )
+
+    def test_skips_options_claimed_by_other_hosts( self ):
+        from whip.sweep import host_class, option_id, claim
+        claimdir = join( 'queue', 'claims', host_class(INFO, 8) )
+        os.makedirs( claimdir )
+        # Another host of the class is running the first xml
+        for option in self.options:
+            claim( join(claimdir, option_id(self.tasks[0], option)) )
+        runs = self._work( 'node1', 8, [1.0, 2.0] )
+        eq_( ['benchmark2.xml'] * 2, [run.xmlfile for run in runs] )
+        # Nothing left unless the other host's claims are stale
+        eq_( [], self._work( 'node2', 8, [] ) )
+        eq_( 2, len(self._work( 'node2', 8, [3.0, 4.0], stale=-1 )) )
+        eq_( [], self._work( 'node3', 8, [], stale=-1 ) )
+
+    def test_each_class_runs_everything( self ):
+        eq_( 4, len(self._work( 'node1', 8, [1.0, 2.0, 3.0, 4.0] )) )
+        eq_( 4, len(self._work( 'big1', 32, [0.5, 0.25, 0.5, ValueError] )) )
+
+    def test_merge_ranks_per_class( self ):
+        from whip.sweep import merge
+        self._work( 'node1', 8, [2.0, 1.0, 2.0, 1.0] )
+        self._work( 'big1', 32, [0.5, 0.25, 0.5, ValueError] )
+        out = StringIO()
+        runs = merge( 'queue', out )
+        eq_( 8, len(runs) )
+        output = out.getvalue()
+        eq_( 2, output.count('Host class') )
+        ok_( 'Hosts: node1' in output )
+        ok_( 'Hosts: big1' in output )
+        ok_( '1. -beagle_SSE -beagle_instances 2' in output )
+        ok_( '2. -beagle_SSE -beagle_instances 2 error' in output )
+        ok_( '8 cores' in output )
+
+    def test_merge_keeps_same_named_xmls_apart( self ):
+        from whip.sweep import init_queue, merge
+        os.makedirs( 'a' )
+        os.makedirs( 'b' )
+        shutil.copy( self.beastfiles[0], join('a', 'beast.xml') )
+        shutil.copy( self.beastfiles[2], join('b', 'beast.xml') )
+        shutil.rmtree( 'queue' )
+        tasks = init_queue( 'queue', ['a/beast.xml', 'b/beast.xml'] )
+        self._work( 'node1', 8, [1.0, 2.0, 50.0, 60.0] )
+        out = StringIO()
+        runs = merge( 'queue', out )
+        output = out.getvalue()
+        for task in tasks:
+            ok_( 'beast.xml ({0})'.format(task) in output )
+        eq_( 2, output.count('1. -beagle_SSE ') )
+        eq_( sorted(tasks * 2), sorted(run.task for run in runs) )
+        # Each xml's runs are ranked on their own
+        groups = sorted(
+            sorted(run.hours for run in runs if run.task == task)
+            for task in tasks
+        )
+        eq_( [[1.0, 2.0], [50.0, 60.0]], groups )
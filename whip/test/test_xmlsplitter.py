@@ -5,6 +5,31 @@ from whip.xmlsplitter import InvalidBeastXmlError
 class Base(BaseXml):
     modulepath = 'whip.xmlsplitter'
 
+class TestParseArgs(Base):
+    functionname = 'parse_args'
+
+    def _error( self, args ):
+        with patch('sys.stderr', StringIO()) as stderr:
+            try:
+                self._C( args )
+                ok_( False, 'Accepted {0}'.format(args) )
+            except SystemExit as e:
+                eq_( 2, e.code )
+        return stderr.getvalue()
+
+    def test_stream_rejects_unsupported_options( self ):
+        ok_( '--patterns cannot be used with --stream' in
+            self._error( ['--stream', '--patterns', 'x.xml'] ) )
+        ok_( '--jobs cannot be used with --stream' in
+            self._error( ['--stream', '--jobs', '4', 'x.xml'] ) )
+        ok_( '--balance similarity cannot be used with --stream' in
+            self._error( ['--stream', '--balance', 'similarity', 'x.xml'] ) )
+
+    def test_stream( self ):
+        args = self._C( ['--stream', 'x.xml'] )
+        ok_( args.stream )
+        eq_( 'x.xml', args.xmlfile )
+
 class TestSetFilenames(Base):
     functionname = 'set_filenames'
 
@@ -24,6 +49,14 @@ class TestSetFilenames(Base):
         ok_( 'beast.log' not in xmlstr )
         ok_( 'beast.trees' not in xmlstr )
 
+    def test_compressed_split_name( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._xml(self.xmlstr)
+        self._C( xml, 'split_0.xml.gz' )
+        xmlstr = etree.tostring( xml )
+        ok_( 'fileName="split_0.log"' in xmlstr )
+        ok_( 'fileName="split_0.trees"' in xmlstr )
+
     def test_any_tag_with_fileName_attr( self ):
         self.xmlstr += '<mytag id="myTag" fileName="replace.me" />\n'
         xml = self._xml(self.xmlstr)
@@ -109,6 +142,545 @@ class TestSplitXml(Base,BaseTempDir):
                 ok_( 'fileName="'+fn in contents )
                 ok_( 'fileName="beast.' not in contents )
 
+    def test_each_split_file_written_once( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 10 )
+        self._writexmlfile( xml, 'input.xml' )
+        from whip.compression import open_file
+        m = Mock(side_effect=open_file)
+        with patch('whip.xmlsplitter.open_file', m):
+            self._C('input.xml', 2)
+        written = [c[0][0] for c in m.call_args_list if c[0][1:] == ('w',)]
+        eq_( ['split_1.xml','split_2.xml'], written )
+
+    def test_splits_contain_every_taxon_once( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 11 )
+        self._writexmlfile( xml, 'input.xml' )
+        self._C('input.xml', 3)
+
+        ids = []
+        for f in ('split_1.xml','split_2.xml','split_3.xml'):
+            sxml = etree.parse(f)
+            tids = [t.attrib['id'] for t in sxml.xpath('taxa')[0]]
+            sids = [s[0].attrib['idref'] for s in sxml.xpath('alignment')[0]]
+            eq_( tids, sids )
+            ids += tids
+        eq_( ['seq{0}'.format(i) for i in range(11)], ids )
+
+class TestSplitXmlJobs(Base,BaseTempDir):
+    functionname = 'split_xml'
+
+    def _split_contents( self, xmlfile, numfiles, jobs ):
+        self._C( xmlfile, numfiles, jobs=jobs )
+        contents = []
+        for f in sorted(f for f in os.listdir('.') if f.startswith('split_')):
+            with open(f) as fh:
+                contents.append( fh.read() )
+            os.unlink(f)
+        return contents
+
+    def test_same_output_as_single_process( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 11 )
+        self._writexmlfile( xml, 'input.xml' )
+        serial = self._split_contents( 'input.xml', 3, 1 )
+        parallel = self._split_contents( 'input.xml', 3, 2 )
+        eq_( 3, len(parallel) )
+        eq_( serial, parallel )
+
+    def test_same_output_as_single_process_for_beast_file( self ):
+        serial = self._split_contents( self.beastfiles[0], 3, 1 )
+        parallel = self._split_contents( self.beastfiles[0], 3, 3 )
+        eq_( serial, parallel )
+
+class TestSplitXmlCache(Base,BaseTempDir):
+    functionname = 'split_xml'
+
+    def _split_contents( self, numfiles, cache ):
+        r = self._C( self.beastfiles[0], numfiles, cache=cache )
+        contents = []
+        for i in range(1, numfiles+1):
+            with open('split_{0}.xml'.format(i)) as fh:
+                contents.append( fh.read() )
+        return r, contents
+
+    def test_cached_split_does_not_parse( self ):
+        from whip.cache import SplitCache
+        cache = SplitCache( join(self.setupdir, 'splits') )
+        three = self._split_contents( 3, None )
+        two = self._split_contents( 2, None )
+        eq_( three, self._split_contents( 3, cache ) )
+        with patch('whip.xmlsplitter.etree.parse') as parse:
+            parse.side_effect = AssertionError('parsed again')
+            eq_( three, self._split_contents( 3, cache ) )
+            # A different number of files reuses the same entry
+            eq_( two, self._split_contents( 2, cache ) )
+
+class TestSplitXmlCompressed(Base,BaseTempDir):
+    functionname = 'split_xml'
+
+    def _plain_splits( self, names ):
+        from whip.compression import open_file
+        contents = []
+        for name in names:
+            with open_file(name) as fh:
+                contents.append( fh.read() )
+            os.unlink( name )
+        return contents
+
+    def setUp( self ):
+        super(TestSplitXmlCompressed,self).setUp()
+        import gzip
+        with open(self.beastfiles[0]) as fh:
+            self.plain = fh.read()
+        with contextlib.closing(gzip.open('input.xml.gz', 'wb')) as fh:
+            fh.write( self.plain )
+        self._C( self.beastfiles[0], 3 )
+        self.expected = self._plain_splits(
+            ['split_{0}.xml'.format(i) for i in (1,2,3)]
+        )
+
+    def test_reads_compressed_input( self ):
+        self._C( 'input.xml.gz', 3 )
+        eq_( self.expected, self._plain_splits(
+            ['split_{0}.xml'.format(i) for i in (1,2,3)]
+        ) )
+
+    def test_writes_compressed_splits( self ):
+        self._C( self.beastfiles[0], 3, compress='gz' )
+        ok_( not exists( 'split_1.xml' ) )
+        eq_( self.expected, self._plain_splits(
+            ['split_{0}.xml.gz'.format(i) for i in (1,2,3)]
+        ) )
+
+    def test_streaming( self ):
+        from whip.xmlsplitter import split_xml_streaming
+        split_xml_streaming( 'input.xml.gz', 3, compress='gz' )
+        eq_( self.expected, self._plain_splits(
+            ['split_{0}.xml.gz'.format(i) for i in (1,2,3)]
+        ) )
+
+class TestSplitXmlStreaming(Base,BaseTempDir):
+    functionname = 'split_xml_streaming'
+
+    def _split_both( self, xmlfile, numfiles ):
+        ''' Return contents of split files from split_xml and streaming '''
+        from whip.xmlsplitter import split_xml
+        results = []
+        for func in (split_xml, self._C):
+            func( xmlfile, numfiles )
+            splits = sorted(f for f in os.listdir('.') if f.startswith('split_'))
+            contents = []
+            for f in splits:
+                with open(f) as fh:
+                    contents.append( fh.read() )
+                os.unlink(f)
+            results.append( contents )
+        return results
+
+    def test_sequences_over_10mb( self ):
+        # libxml2 refuses text nodes over 10MB unless huge_tree is on
+        residues = 'ACGT' * (11 * 1024 * 1024 / 4)
+        self.xmlstr += '<taxa id="taxa"><taxon id="seq0"/><taxon id="seq1"/></taxa>\n'
+        self.xmlstr += '<alignment id="alignment" dataType="nucleotide">'
+        for i in range(2):
+            self.xmlstr += '<sequence><taxon idref="seq{0}"/>{1}</sequence>'.format(i, residues)
+        self.xmlstr += '</alignment>\n'
+        self._add_filename_log_xml('beast')
+        self._writexmlfile( self.xmlstr + '</beast>', 'input.xml' )
+        inmemory, streamed = self._split_both( 'input.xml', 2 )
+        eq_( inmemory, streamed )
+        eq_( 2, len(streamed) )
+        ok_( residues in streamed[1] )
+
+    def test_same_output_as_split_xml( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 11 )
+        self._writexmlfile( xml, 'input.xml' )
+        inmemory, streamed = self._split_both( 'input.xml', 3 )
+        eq_( 3, len(streamed) )
+        eq_( inmemory, streamed )
+
+    def test_same_output_as_split_xml_for_beast_file( self ):
+        inmemory, streamed = self._split_both( self.beastfiles[0], 3 )
+        eq_( 3, len(streamed) )
+        eq_( inmemory, streamed )
+
+    def test_removes_spool_files( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 10 )
+        self._writexmlfile( xml, 'input.xml' )
+        self._C( 'input.xml', 2 )
+        eq_( ['input.xml','split_1.xml','split_2.xml'], sorted(os.listdir('.')) )
+
+    @raises(InvalidBeastXmlError)
+    def test_idtaxa_not_same_length_as_seqtaxa( self ):
+        self.xmlstr += '<taxa id="taxa"><taxon id="seq1"></taxon><taxon id="seq2"/></taxa>\n'
+        self.xmlstr += '<alignment id="alignment" dataType="nucleotide"><sequence><taxon idref="seq1"/>ATGC</sequence></alignment>\n'
+        self._writexmlfile( self._xml(self.xmlstr), 'input.xml' )
+        self._C( 'input.xml', 2 )
+
+class TestStreamTaxaSequences(Base,BaseTempDir):
+    functionname = 'stream_taxa_sequences'
+
+    def test_routes_taxa_and_sequences_and_returns_template( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 5 )
+        self._writexmlfile( xml, 'input.xml' )
+        routed = []
+        def route( kind, element ):
+            routed.append( (kind, element.tag) )
+        template = self._C( 'input.xml', route )
+        eq_( [('taxon','taxon')]*5 + [('sequence','sequence')]*5, routed )
+        eq_( [], template.xpath('taxa')[0].getchildren() )
+        eq_( [], template.xpath('alignment')[0].getchildren() )
+        ok_( template.find('.//log') is not None )
+
+    @raises(InvalidBeastXmlError)
+    def test_missing_alignment( self ):
+        self.xmlstr += '<taxa id="taxa"></taxa>\n'
+        self._writexmlfile( self._xml(self.xmlstr), 'input.xml' )
+        self._C( 'input.xml', lambda kind, element: None )
+
+class CostXml(Base):
+    def _costxml( self, residues ):
+        ''' Build xml where sequence i has residues[i] ungapped characters '''
+        width = max(residues)
+        taxons = ['<taxon id="seq{0}"/>'.format(i) for i in range(len(residues))]
+        sequences = [
+            '<sequence><taxon idref="seq{0}"/>{1}</sequence>'.format(
+                i, ('A' * r).ljust(width, '-'))
+            for i, r in enumerate(residues)
+        ]
+        self.xmlstr += '<taxa id="taxa">{0}</taxa>\n'.format(''.join(taxons))
+        self.xmlstr += '<alignment id="alignment" dataType="nucleotide">{0}</alignment>\n'.format(''.join(sequences))
+        self._add_filename_log_xml('beast')
+        return self._xml(self.xmlstr)
+
+class TestSplitXmlBalance(CostXml,BaseTempDir):
+    functionname = 'split_xml'
+
+    def setUp( self ):
+        super(TestSplitXmlBalance,self).setUp()
+        self.residues = [100, 1, 1, 1, 50, 50, 1, 1, 1, 1]
+        self._writexmlfile( self._costxml(self.residues), 'input.xml' )
+
+    def test_taxa_balance_returns_residue_costs( self ):
+        r = self._C( 'input.xml', 2 )
+        eq_( [153, 54], r )
+
+    def test_cost_balance_equalizes_residues( self ):
+        r = self._C( 'input.xml', 2, balance='cost' )
+        eq_( [104, 103], r )
+        s1 = etree.parse('split_1.xml').xpath('taxa')[0]
+        eq_( ['seq0','seq1','seq3','seq7','seq9'], [t.attrib['id'] for t in s1] )
+
+    def test_pattern_costs( self ):
+        r, patterns = self._C( 'input.xml', 2, balance='cost', patterns=True )
+        # The split with seq0 has 2 kinds of column and the split with the
+        # two 50 residue sequences has 3
+        eq_( [2, 3], patterns )
+        eq_( [5 * 2, 5 * 3], r )
+        from whip.xmlsplitter import xml_site_patterns
+        eq_( patterns, [xml_site_patterns('split_{0}.xml'.format(i)) for i in (1,2)] )
+
+    def test_streaming_matches_in_memory( self ):
+        from whip.xmlsplitter import split_xml_streaming
+        r = self._C( 'input.xml', 3, balance='cost' )
+        inmemory = [open('split_{0}.xml'.format(i)).read() for i in (1,2,3)]
+        s = split_xml_streaming( 'input.xml', 3, balance='cost' )
+        streamed = [open('split_{0}.xml'.format(i)).read() for i in (1,2,3)]
+        eq_( r, s )
+        eq_( inmemory, streamed )
+
+class TestSplitXmlSimilarity(Base,BaseTempDir):
+    functionname = 'split_xml'
+
+    def setUp( self ):
+        super(TestSplitXmlSimilarity,self).setUp()
+        # Two families of sequences, each a few mutations from its own
+        # ancestor, interleaved in the alignment
+        rand = random.Random(1)
+        ancestors = [
+            [rand.choice('ACGT') for i in range(60)] for family in range(2)
+        ]
+        sequences = []
+        for i in range(8):
+            sequence = list(ancestors[i % 2])
+            for site in rand.sample(range(60), 3):
+                sequence[site] = rand.choice('ACGT')
+            sequences.append(''.join(sequence))
+        taxons = ['<taxon id="seq{0}"/>'.format(i) for i in range(8)]
+        seqs = [
+            '<sequence><taxon idref="seq{0}"/>{1}</sequence>'.format(i, s)
+            for i, s in enumerate(sequences)
+        ]
+        self.xmlstr += '<taxa id="taxa">{0}</taxa>\n'.format(''.join(taxons))
+        self.xmlstr += '<alignment id="alignment" dataType="nucleotide">{0}</alignment>\n'.format(''.join(seqs))
+        self._add_filename_log_xml('beast')
+        self._writexmlfile( self._xml(self.xmlstr), 'input.xml' )
+
+    def _taxa( self, splitfile ):
+        taxa = etree.parse(splitfile).xpath('taxa')[0]
+        return [t.attrib['id'] for t in taxa]
+
+    def test_groups_similar_sequences( self ):
+        r, patterns = self._C( 'input.xml', 2, balance='similarity', patterns=True )
+        eq_( ['seq0','seq2','seq4','seq6'], self._taxa('split_1.xml') )
+        eq_( ['seq1','seq3','seq5','seq7'], self._taxa('split_2.xml') )
+        taxa, patterns = self._C( 'input.xml', 2, patterns=True )
+        ok_( max(r) < min(taxa), (r, taxa) )
+
+    @raises(ValueError)
+    def test_not_streamed( self ):
+        from whip.xmlsplitter import split_xml_streaming
+        split_xml_streaming( 'input.xml', 2, balance='similarity' )
+
+class TestCostSplitIterable(object):
+    def _C( self, *args, **kwargs ):
+        from whip.xmlsplitter import cost_split_iterable
+        return list(cost_split_iterable( *args, **kwargs ))
+
+    def test_heaviest_first_into_lightest( self ):
+        r = self._C( 'abcde', [5, 4, 3, 3, 3], 2 )
+        eq_( [['a','d'], ['b','c','e']], r )
+
+    def test_keeps_original_order( self ):
+        r = self._C( range(6), [1, 1, 1, 1, 1, 10], 2 )
+        eq_( [[5], [0,1,2,3,4]], r )
+
+    def test_drops_empty_pieces( self ):
+        r = self._C( 'ab', [1, 1], 4 )
+        eq_( [['a'], ['b']], r )
+
+class TestSplitChunks(object):
+    @raises(ValueError)
+    def test_unknown_balance( self ):
+        from whip.xmlsplitter import split_chunks
+        split_chunks( range(4), 2, 'bogus' )
+
+    def test_similarity_maps_rows_to_items( self ):
+        from whip.xmlsplitter import split_chunks
+        from whip.alignment import AlignmentStore
+        m = AlignmentStore.from_residues( 'abcd', ['AA', 'CC', 'AA', 'CC'] ).rows()
+        eq_( [['a','c'], ['b','d']], split_chunks( 'abcd', 2, 'similarity', matrix=m ) )
+
+class TestSequenceCost(Base):
+    functionname = 'sequence_cost'
+
+    def test_counts_ungapped_residues( self ):
+        seq = etree.fromstring(
+            '<sequence>\n  <taxon idref="a"/>\n  AT-G?C\n  NN--\n</sequence>'
+        )
+        eq_( 6, self._C( seq ) )
+
+class TestCountSitePatterns(Base):
+    functionname = 'count_site_patterns'
+
+    def test_counts_unique_columns( self ):
+        seqs = [
+            etree.fromstring('<sequence><taxon idref="a"/>AAAT</sequence>'),
+            etree.fromstring('<sequence><taxon idref="b"/>CCCT</sequence>'),
+        ]
+        eq_( 2, self._C( seqs ) )
+
+class TestXmlSitePatterns(Base,BeastBase):
+    functionname = 'xml_site_patterns'
+
+    def test_counts_alignment_patterns( self ):
+        from whip.xmlsplitter import count_site_patterns
+        xml = etree.parse( self.beastfiles[0] )
+        eq_( count_site_patterns(xml.xpath('alignment/sequence')),
+            self._C( self.beastfiles[0] ) )
+        ok_( self._C( self.beastfiles[0] ) > 0 )
+
+class TestImbalance(Base):
+    functionname = 'imbalance'
+
+    def test_balanced( self ):
+        eq_( 0.0, self._C( [5, 5, 5] ) )
+
+    def test_imbalanced( self ):
+        assert_almost_equal( 0.5, self._C( [3, 1] ) )
+
+    def test_all_zero( self ):
+        eq_( 0.0, self._C( [0, 0] ) )
+
+class TestWriteSamples(Base,BaseTempDir):
+    functionname = 'write_samples'
+
+    def test_writes_random_subalignments( self ):
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 20 )
+        self._writexmlfile( xml, 'input.xml' )
+        r = self._C( 'input.xml', [2, 5], '.' )
+        eq_( ['./sample_2.xml', './sample_5.xml'], r )
+        for size, path in zip([2, 5], r):
+            sxml = etree.parse(path)
+            tids = [t.attrib['id'] for t in sxml.xpath('taxa')[0]]
+            sids = [s[0].attrib['idref'] for s in sxml.xpath('alignment')[0]]
+            eq_( size, len(tids) )
+            eq_( tids, sids )
+            ok_( 'dimension="{0}"'.format(size-1) in etree.tostring(sxml) )
+
+class TestFitRuntimeModel(Base):
+    functionname = 'fit_runtime_model'
+
+    def test_fits_line( self ):
+        fixed, pertaxon = self._C( [(10, 2.0), (20, 3.0), (30, 4.0)] )
+        assert_almost_equal( 1.0, fixed )
+        assert_almost_equal( 0.1, pertaxon )
+
+    @raises(ValueError)
+    def test_needs_two_sizes( self ):
+        self._C( [(10, 2.0), (10, 3.0)] )
+
+class TestChooseNumfiles(Base,BaseTempDir):
+    functionname = 'choose_numfiles'
+
+    def setUp( self ):
+        super(TestChooseNumfiles,self).setUp()
+        self._add_filename_log_xml('beast')
+        xml = self._taxseqxml( 100 )
+        self._writexmlfile( xml, 'input.xml' )
+
+    def _estimate( self, xmlfile, seed, stream, **beast_options ):
+        ''' Pretend every run takes 1 hour plus 0.1 hour per taxon '''
+        numtaxa = len(etree.parse(xmlfile).xpath('taxa')[0])
+        self.estimated.append( (numtaxa, beast_options) )
+        return 1.0 + 0.1 * numtaxa
+
+    def _run( self, *args, **kwargs ):
+        self.estimated = []
+        with patch('whip.xmlsplitter.estimate_beast_runtime', Mock(side_effect=self._estimate)):
+            return self._C( *args, **kwargs )
+
+    def test_picks_numfiles_within_budget( self ):
+        numfiles, predicted = self._run( 'input.xml', 3.5, **{'-beagle_SSE':True} )
+        # 25 taxa fit in 3.5 hours
+        eq_( 4, numfiles )
+        eq_( [3.5] * 4, predicted )
+        eq_( [(5, {'-beagle_SSE':True}), (10, {'-beagle_SSE':True})], self.estimated )
+
+    def test_uneven_chunks_stay_within_budget( self ):
+        numfiles, predicted = self._run( 'input.xml', 4.0, sample_sizes=[10, 40] )
+        ok_( max(predicted) <= 4.0 )
+        eq_( 4, numfiles )
+
+    def test_cost_balance_stays_within_budget( self ):
+        from whip.xmlsplitter import split_xml
+        # Half the taxa are mostly gaps so the cost balance packs more of
+        # them into a file than the taxa balance would
+        with open('input.xml') as fh:
+            xml = fh.read()
+        for i in range(0, 100, 2):
+            xml = xml.replace(
+                'idref="seq{0}"/>ATGC'.format(i), 'idref="seq{0}"/>A---'.format(i)
+            )
+        self._writexmlfile( xml, 'input.xml' )
+        numfiles, predicted = self._run( 'input.xml', 3.5, balance='cost' )
+        ok_( max(predicted) <= 3.5, predicted )
+        split_xml( 'input.xml', numfiles, balance='cost' )
+        sizes = [
+            len(etree.parse('split_{0}.xml'.format(i)).xpath('taxa')[0])
+            for i in range(1, len(predicted)+1)
+        ]
+        for size, hours in zip(sizes, predicted):
+            assert_almost_equal( 1.0 + 0.1 * size, hours )
+
+    def test_single_file_when_whole_fits( self ):
+        numfiles, predicted = self._run( 'input.xml', 100.0 )
+        eq_( 1, numfiles )
+        assert_almost_equal( 11.0, predicted[0] )
+
+    @raises(ValueError)
+    def test_impossible_budget( self ):
+        self._run( 'input.xml', 0.5 )
+
+    def test_removes_sample_files( self ):
+        self._run( 'input.xml', 3.5 )
+        eq_( ['input.xml'], os.listdir('.') )
+
+class TestWriteRunScripts(Base,BaseTempDir):
+    functionname = 'write_run_scripts'
+
+    def test_runs_beast_with_option_in_split_directory( self ):
+        os.mkdir( 'out' )
+        r = self._C( ['out/split_1.xml', 'out/split_2.xml'],
+            '-beagle_SSE -beagle_instances 4' )
+        eq_( ['out/run_split_1.sh', 'out/run_split_2.sh'], r )
+        with open(r[1]) as fh:
+            lines = fh.read().splitlines()
+        eq_( 'cd "$(dirname "$0")"', lines[1] )
+        eq_( 'exec beast -beagle_SSE -beagle_instances 4 split_2.xml', lines[2] )
+        ok_( os.access( r[0], os.X_OK ) )
+
+    def test_no_options( self ):
+        r = self._C( ['split_1.xml'], '' )
+        with open(r[0]) as fh:
+            eq_( 'exec beast split_1.xml', fh.read().splitlines()[2] )
+
+class TestOptimiseSplits(Base,BaseTempDir):
+    functionname = 'optimise_splits'
+
+    def test_sweeps_most_expensive_split_once( self ):
+        from whip.beagleoptimiser import BeastRun
+        splits = ['split_1.xml', 'split_2.xml', 'split_3.xml']
+        with patch('whip.xmlsplitter.run_beast_options') as p:
+            p.return_value = [
+                BeastRun( '-beagle_SSE -beagle_instances 2', 1.0 ),
+                BeastRun( '-beagle_SSE', 2.0 ),
+            ]
+            best, scripts = self._C( splits, [10, 30, 20], StringIO(), jobs=2 )
+        eq_( 1, p.call_count )
+        eq_( 'split_2.xml', p.call_args[0][0] )
+        eq_( 2, p.call_args[1]['jobs'] )
+        eq_( ('-beagle_SSE -beagle_instances 2', 1.0), best )
+        eq_( ['run_split_1.sh', 'run_split_2.sh', 'run_split_3.sh'], scripts )
+
+    @raises(ValueError)
+    def test_no_estimates( self ):
+        from whip.beagleoptimiser import BeastRun
+        with patch('whip.xmlsplitter.run_beast_options') as p:
+            p.return_value = [BeastRun( '-beagle_SSE', sys.maxint, 'error' )]
+            self._C( ['split_1.xml'], [1], StringIO() )
+
+@attr('benchmark')
+class TestSplitXmlScaling(Base,BaseTempDir):
+    '''
+    Regression benchmark to ensure split_xml scales linearly with the number
+    of sequences. Skip it with nosetests -a '!benchmark'
+    '''
+    functionname = 'split_xml'
+
+    def _synthetic_xml( self, num, xmlfilepath ):
+        xmlstr = self.xmlstr
+        xmlstr += '<taxa id="taxa">'
+        xmlstr += ''.join('<taxon id="seq{0}"/>'.format(i) for i in range(num))
+        xmlstr += '</taxa>\n<alignment id="alignment" dataType="nucleotide">'
+        xmlstr += ''.join(
+            '<sequence><taxon idref="seq{0}"/>ATGCATGCAT</sequence>'.format(i)
+            for i in range(num)
+        )
+        xmlstr += '</alignment>\n'
+        xmlstr += '<parameter id="skyride.logPopSize" dimension="{0}"/>\n'.format(num)
+        xmlstr += '<log id="fileLog" fileName="beast.log"/>\n</beast>\n'
+        self._writexmlfile( xmlstr, xmlfilepath )
+
+    def test_scales_linearly_with_sequence_count( self ):
+        import time
+        sizes = (1000, 10000, 100000)
+        per_seq = []
+        for num in sizes:
+            self._synthetic_xml( num, 'input.xml' )
+            start = time.time()
+            self._C( 'input.xml', 4 )
+            per_seq.append( (time.time() - start) / num )
+        # Quadratic growth would make each step ~10x slower per sequence
+        for smaller, larger in zip(per_seq, per_seq[1:]):
+            ok_( larger < smaller * 3 )
+
 class TestGetAllIDtaxaSeqtaxa(Base):
     functionname = 'get_all_idtaxa_seqtaxa'
 
@@ -1,10 +1,34 @@
 # coding: utf-8
 
 from lxml import etree
-import re
 import argparse
 import sys
-from os.path import splitext, basename
+import tempfile
+import shutil
+import multiprocessing
+import heapq
+import random
+import math
+import os
+import pipes
+from os.path import splitext, basename, join
+
+from whip.compression import open_file, strip_compression, EXTENSIONS
+from whip.alignment import (
+    GAP_CHARS,
+    AlignmentStore,
+    sequence_residues,
+    similarity_split,
+)
+from whip.beagleoptimiser import (
+    estimate_beast_runtime,
+    run_beast_options,
+)
+
+# Comments used to mark where the taxa and sequences of a split go inside
+# a serialized template
+TAXA_MARKER = 'whip:taxa'
+ALIGNMENT_MARKER = 'whip:alignment'
 
 # Exception for invalid Beast xml
 class InvalidBeastXmlError(Exception): pass
@@ -26,12 +50,139 @@ def parse_args( args=sys.argv[1:] ):
             'match how many computers you will split the run across. Default: %(default)s'
     )
 
+    parser.add_argument(
+        '--stream',
+        dest='stream',
+        action='store_true',
+        default=False,
+        help='Parse the xml incrementally and write taxa and sequences ' \
+            'straight to the split files so only the rest of the document is ' \
+            'kept in memory. Use this for alignments larger than memory'
+    )
+
+    parser.add_argument(
+        '--balance',
+        dest='balance',
+        choices=('taxa','cost','similarity'),
+        default='taxa',
+        help='taxa puts the same number of taxa in every file. cost weighs ' \
+            'each sequence by its ungapped residue count and packs them so ' \
+            'every file has about the same predicted cost. similarity makes ' \
+            'exactly that many files whose taxa counts differ by at most one ' \
+            'and groups similar sequences together so each file has fewer ' \
+            'site patterns. ' \
+            'similarity cannot be used with --stream. Default: %(default)s'
+    )
+
+    parser.add_argument(
+        '--patterns',
+        dest='patterns',
+        action='store_true',
+        default=False,
+        help='Predict the cost of each file from its unique site patterns ' \
+            'times its taxa instead of its residue count and report the site ' \
+            'patterns of every file. Not available with --stream'
+    )
+
+    parser.add_argument(
+        '--budget',
+        dest='budget',
+        type=float,
+        default=None,
+        help='Target wall clock hours for every split file. Small random ' \
+            'samples of the alignment are run with beast to fit how the run ' \
+            'time grows per taxon and then --nodes is picked so every split ' \
+            'file is predicted to finish within this many hours'
+    )
+
+    parser.add_argument(
+        '--beagle-options',
+        dest='beagle_options',
+        default='',
+        help='Beagle options to estimate the --budget samples with such as ' \
+            'one picked by beagle_optimiser. Example: ' \
+            '--beagle-options "-beagle_SSE -beagle_instances 2"'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='How many processes to build and write the split files with. ' \
+            'Not available with --stream. Default: %(default)s'
+    )
+
+    parser.add_argument(
+        '--compress',
+        dest='compress',
+        choices=sorted(EXTENSIONS),
+        default=None,
+        help='Compress the split files with this codec and name them ' \
+            'split_N.xml.<codec>. xz needs backports.lzma and zst needs ' \
+            'zstandard installed. Input files ending in .gz, .xz or .zst are ' \
+            'always decompressed while they are read. beast only reads plain ' \
+            'xml so this cannot be used with --optimise'
+    )
+
+    parser.add_argument(
+        '--cache',
+        dest='usecache',
+        action='store_true',
+        default=False,
+        help='Read and store the parsed xml in the split cache. The parsed ' \
+            'xml is cached per file path, size and modification time so ' \
+            'splitting the same xml again into a different number of files ' \
+            'does not parse it again. The cache takes about twice the size ' \
+            'of the alignment on disk and keeps at most 10GB of entries ' \
+            'used within the last week. Not used with --stream'
+    )
+
+    parser.add_argument(
+        '--optimise',
+        dest='optimise',
+        action='store_true',
+        default=False,
+        help='After splitting run the beagle_optimiser sweep once on the ' \
+            'split file with the highest predicted cost and write a ' \
+            'run_split_N.sh script for every split file that runs it with ' \
+            'the fastest options. --jobs is also used for the sweep'
+    )
+
     parser.add_argument(
         dest='xmlfile',
         help='The xmlfile that should be split'
     )
 
-    return parser.parse_args()
+    args = parser.parse_args( args )
+    # The streaming split never has every sequence at once to count patterns
+    #  with and writes the files in a single process
+    if args.stream and args.patterns:
+        parser.error( '--patterns cannot be used with --stream' )
+    if args.stream and args.jobs != 1:
+        parser.error( '--jobs cannot be used with --stream' )
+    if args.stream and args.balance == 'similarity':
+        parser.error( '--balance similarity cannot be used with --stream' )
+    return args
+
+def parse_xml( xmlfile ):
+    '''
+    Parse xmlfile decompressing it on the fly if its extension says it is
+    compressed(see whip.compression)
+    huge_tree lets sequences be longer than libxml2's 10MB text node limit
+    '''
+    with open_file(xmlfile) as fh:
+        return etree.parse(fh, etree.XMLParser(huge_tree=True))
+
+def split_filename( i, compress=None ):
+    '''
+    Name of the i'th split file, ending in the extension of the compress
+    codec if given
+    '''
+    splitfile = 'split_{0}.xml'.format(i)
+    if compress is not None:
+        splitfile += EXTENSIONS[compress]
+    return splitfile
 
 def get_all_idtaxa_seqtaxa( xml ):
     '''
@@ -73,7 +224,7 @@ def set_filenames( xml, filename ):
     by essentially replacing whatever the value is before the extension with filename
     '''
     # Get only filename portion of filename
-    filen = splitext(basename(filename))[0]
+    filen = splitext(basename(strip_compression(filename)))[0]
 
     # Should find any tag with attribute named fileName
     elements = xml.findall('.//*[@fileName]')
@@ -84,7 +235,7 @@ def set_filenames( xml, filename ):
         )
 
     for element in elements:
-        fn = splitext(basename(element.attrib['fileName']))[0]
+        fn = splitext(basename(strip_compression(element.attrib['fileName'])))[0]
         # Replace the filename in existing path with our filename name
         element.attrib['fileName'] = element.attrib['fileName'].replace(fn, filen)
 
@@ -123,24 +274,505 @@ def evenly_split_iterable( iterable, numtimes ):
         end = s+splits
         yield iterable[start:end]
 
-def split_xml( xmlfile, numfiles ):
+def cost_split_iterable( iterable, weights, numtimes ):
+    '''
+    Splits an iterable into at most numtimes pieces whose summed weights are
+    as close as possible to each other
+
+    Uses the greedy longest processing time rule, heaviest item first into
+    the currently lightest piece. Items keep their original order inside
+    each piece
+    '''
+    bins = [(0, i) for i in range(numtimes)]
+    members = [[] for i in range(numtimes)]
+    order = sorted(range(len(iterable)), key=lambda i: weights[i], reverse=True)
+    for i in order:
+        load, b = heapq.heappop(bins)
+        members[b].append(i)
+        heapq.heappush(bins, (load + weights[i], b))
+
+    for member in members:
+        if member:
+            yield [iterable[i] for i in sorted(member)]
+
+def split_chunks( iterable, numtimes, balance='taxa', weights=None,
+        matrix=None ):
+    '''
+    Split iterable with the given balance strategy
+    taxa - evenly_split_iterable
+    cost - cost_split_iterable using weights
+    similarity - similarity_split of matrix, the AlignmentStore.rows of iterable
+    '''
+    if balance == 'taxa':
+        return list(evenly_split_iterable(iterable, numtimes))
+    elif balance == 'cost':
+        return list(cost_split_iterable(iterable, weights, numtimes))
+    elif balance == 'similarity':
+        items = list(iterable)
+        return [
+            [items[i] for i in chunk]
+            for chunk in similarity_split(matrix, numtimes)
+        ]
+    raise ValueError('Unknown balance strategy {0}'.format(balance))
+
+def sequence_cost( sequence ):
+    '''
+    Predicted cost of a <sequence> element which is its number of
+    ungapped residues
+    '''
+    residues = sequence_residues( sequence )
+    return len(residues) - sum(residues.count(c) for c in GAP_CHARS)
+
+def count_site_patterns( sequences ):
+    '''
+    Count the unique alignment columns(site patterns) across a list of
+    <sequence> elements
+    '''
+    return AlignmentStore.from_sequences( sequences ).site_patterns()
+
+def xml_site_patterns( xmlfile ):
+    '''
+    Count the site patterns of the alignment in a beast xml file
+    '''
+    xml = parse_xml(xmlfile)
+    return count_site_patterns( xml.xpath('alignment/sequence') )
+
+def imbalance( costs ):
+    '''
+    How much larger the most expensive cost is than the mean cost as a
+    fraction. 0.0 means perfectly balanced
+    '''
+    mean = float(sum(costs)) / len(costs)
+    if mean == 0:
+        return 0.0
+    return max(costs) / mean - 1
+
+class SplitSource(object):
+    '''
+    Everything split_xml needs from an xml file
+
+    template - The serialized xml with its taxa and alignment emptied
+    taxa - Serialized <taxa><taxon> of every taxon
+    sequences - Serialized <alignment><sequence> of every taxon
+    store - AlignmentStore of the sequences
+    '''
+    def __init__( self, template, taxa, sequences, store ):
+        self.template = template
+        self.taxa = taxa
+        self.sequences = sequences
+        self.store = store
+
+    @classmethod
+    def parse( cls, xmlfile ):
+        '''
+        Parse xmlfile into a SplitSource
+        '''
+        xml = parse_xml(xmlfile)
+        idseq = get_all_idtaxa_seqtaxa( xml )
+        store = AlignmentStore.from_sequences( [staxa for itaxa, staxa in idseq] )
+        taxa = [etree.tostring(itaxa) for itaxa, staxa in idseq]
+        sequences = [etree.tostring(staxa) for itaxa, staxa in idseq]
+        clear_align_taxa( xml )
+        return cls( etree.tostring(xml), taxa, sequences, store )
+
+    @classmethod
+    def load( cls, xmlfile, cache=None ):
+        '''
+        Get the SplitSource of xmlfile from cache(a SplitCache) or parse it
+        and store it in cache
+        '''
+        if cache is None:
+            return cls.parse( xmlfile )
+        cached = cache.get( xmlfile )
+        if cached is not None:
+            return cls( *cached )
+        source = cls.parse( xmlfile )
+        cache.put(
+            xmlfile, source.template, source.taxa, source.sequences,
+            source.store
+        )
+        return source
+
+def split_xml( xmlfile, numfiles, jobs=1, balance='taxa', patterns=False,
+        cache=None, compress=None ):
     '''
     Splits a given xmlfile file into numfiles number of smaller xml files
 
+    The xml is read into a SplitSource once and every split file is written
+    in a single pass from the patched template and the serialized taxa and
+    sequences of its chunk
+
+    balance - taxa, cost or similarity(see split_chunks)
+    patterns - Predict each file's cost as its unique site patterns times its
+        taxa instead of its summed ungapped residues and also return the
+        site patterns of each file
+
+    jobs - How many processes to write the split files with. With more than
+        one each worker only receives the serialized template and the
+        serialized taxa and sequences of its split
+    cache - SplitCache to read the SplitSource from so the same xmlfile is
+        only parsed once
+    compress - Codec(see whip.compression) to compress the split files with
+        which also names them split_N.xml.<codec>
+
+    Returns the predicted cost of each split file in order or with patterns
+    (predicted costs, site patterns of each split file)
+
     TODO:
         Should warn the user or something if len(chunk) < 100
     '''
-    xml = etree.parse(xmlfile)
+    source = SplitSource.load( xmlfile, cache )
+    store = source.store
+    costs = store.costs().tolist()
+    chunks = split_chunks(
+        range(len(store)), numfiles, balance, costs, store.rows()
+    )
+    if patterns:
+        sitepatterns = [store.site_patterns(chunk) for chunk in chunks]
+        predicted = [
+            len(chunk) * p for chunk, p in zip(chunks, sitepatterns)
+        ]
+    else:
+        predicted = [sum(costs[i] for i in chunk) for chunk in chunks]
+
+    tasks = []
+    for i, chunk in enumerate(chunks, start=1):
+        tasks.append((
+            source.template,
+            split_filename(i, compress),
+            [source.taxa[j] for j in chunk],
+            [source.sequences[j] for j in chunk],
+        ))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(write_split, tasks, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            write_split( task )
+    if patterns:
+        return predicted, sitepatterns
+    return predicted
+
+def write_split( task ):
+    '''
+    Write a single split file from a (template, splitfile, taxa, sequences)
+    tuple where template is the serialized xml with its taxa and alignment
+    emptied and taxa/sequences are lists of serialized elements
+
+    Only takes strings so it can be used as a process pool worker
+    '''
+    template, splitfile, taxa, sequences = task
+    xml = etree.fromstring(template).getroottree()
+    head, middle, tail = template_pieces(xml, splitfile, len(taxa))
+    with open_file(splitfile,'w') as fh:
+        fh.write(head)
+        fh.writelines(taxa)
+        fh.write(middle)
+        fh.writelines(sequences)
+        fh.write(tail)
+
+def template_pieces( xml, splitfile, numseqs ):
+    '''
+    Patch the dimensions and fileName attributes of a template xml(taxa and
+    alignment already emptied) for splitfile and serialize it
+
+    Returns the (head, middle, tail) strings that go before the taxa, between
+    the taxa and the sequences and after the sequences of that split
+    '''
+    set_dimensions(xml, numseqs)
+    set_filenames(xml, splitfile)
+    taxa = xml.xpath('taxa')[0]
+    alignment = xml.xpath('alignment')[0]
+    taxamark = etree.Comment(TAXA_MARKER)
+    alignmark = etree.Comment(ALIGNMENT_MARKER)
+    taxa.append(taxamark)
+    alignment.append(alignmark)
+    xmlstr = etree.tostring(xml)
+    taxa.remove(taxamark)
+    alignment.remove(alignmark)
+
+    head, taxasep, rest = xmlstr.partition(etree.tostring(taxamark))
+    middle, alignsep, tail = rest.partition(etree.tostring(alignmark))
+    if not alignsep:
+        raise InvalidBeastXmlError('taxa tag must come before the alignment tag')
+    return head, middle, tail
+
+def stream_taxa_sequences( xmlfile, route ):
+    '''
+    Incrementally parse xmlfile and call route('taxon', element) for every
+    <taxa><taxon> and route('sequence', element) for every <alignment><sequence>
+
+    Each element is removed from the tree once route returns so only the
+    template portion of the document is ever held in memory
+
+    Returns the template tree with its taxa and alignment emptied
+    '''
+    taxa = None
+    alignment = None
+    counts = {'taxon': 0, 'sequence': 0}
+    root = None
+    # An element's tail text is only complete once the parser has moved past
+    # it and libxml2 still appends to the most recent node, so each element is
+    # routed and removed once its next sibling or its parent has ended
+    pending = []
+    def flush():
+        for kind, element in pending:
+            route(kind, element)
+            counts[kind] += 1
+            element.getparent().remove(element)
+        del pending[:]
+
+    with open_file(xmlfile) as fh:
+        # Whole genome sequences are larger than libxml2's default 10MB
+        #  limit on a single text node
+        for event, element in etree.iterparse(
+                fh, events=('start','end'), huge_tree=True):
+            parent = element.getparent()
+            if parent is None:
+                root = element
+                continue
+            if event == 'start':
+                # Only the first top level taxa and alignment tags are split
+                if parent.getparent() is None:
+                    if element.tag == 'taxa' and taxa is None:
+                        taxa = element
+                    elif element.tag == 'alignment' and alignment is None:
+                        alignment = element
+                continue
+            if element is taxa or element is alignment:
+                flush()
+            elif parent is taxa and element.tag == 'taxon':
+                flush()
+                pending.append( ('taxon', element) )
+            elif parent is alignment and element.tag == 'sequence':
+                flush()
+                pending.append( ('sequence', element) )
+
+    if taxa is None:
+        raise InvalidBeastXmlError('Missing taxa tag')
+    if alignment is None:
+        raise InvalidBeastXmlError('Missing alignment tag')
+    if counts['taxon'] != counts['sequence']:
+        raise InvalidBeastXmlError(
+            'There are not the same amount of alignment sequences as there are ' \
+            ' taxa taxons'
+        )
+    return root.getroottree()
+
+def stream_sequence_costs( xmlfile ):
+    '''
+    Get the sequence_cost of every <alignment><sequence> in xmlfile without
+    holding them in memory
+    '''
+    costs = []
+    def route( kind, element ):
+        if kind == 'sequence':
+            costs.append( sequence_cost(element) )
+    stream_taxa_sequences( xmlfile, route )
+    return costs
+
+def split_xml_streaming( xmlfile, numfiles, balance='taxa', compress=None ):
+    '''
+    Splits xmlfile into the same numfiles files as split_xml without ever
+    parsing the whole document into memory
+
+    The file is read twice. The first pass gets the cost of every sequence so
+    the chunks are known. The second pass routes every taxon and sequence into
+    per split spool files next to the output and then each split file is
+    assembled from the patched template and its spools
+
+    similarity balance needs every sequence in memory at once so is not
+    supported
+    compress - See split_xml
+
+    Returns the predicted cost of each split file in order
+    '''
+    if balance == 'similarity':
+        raise ValueError('similarity balance cannot be used when streaming')
+    costs = stream_sequence_costs( xmlfile )
+    numseqs = len(costs)
+    chunks = split_chunks(range(numseqs), numfiles, balance, costs)
+    # Which chunk each taxon/sequence position belongs to
+    chunkof = [None] * numseqs
+    for i, chunk in enumerate(chunks):
+        for position in chunk:
+            chunkof[position] = i
+
+    # Spool next to the output as the system tempdir may be memory backed
+    spooldir = tempfile.mkdtemp(prefix='splitxml', dir='.')
+    spools = {}
+    try:
+        for kind in ('taxon', 'sequence'):
+            spools[kind] = [
+                open('{0}/{1}_{2}'.format(spooldir, kind, i), 'w+b')
+                for i in range(len(chunks))
+            ]
+        position = {'taxon': 0, 'sequence': 0}
+        def route( kind, element ):
+            i = position[kind]
+            if i >= numseqs:
+                raise InvalidBeastXmlError(
+                    'There are not the same amount of alignment sequences as ' \
+                    'there are taxa taxons'
+                )
+            spools[kind][chunkof[i]].write( etree.tostring(element) )
+            position[kind] += 1
+        xml = stream_taxa_sequences( xmlfile, route )
+
+        for i, chunk in enumerate(chunks):
+            splitfile = split_filename(i+1, compress)
+            head, middle, tail = template_pieces(xml, splitfile, len(chunk))
+            with open_file(splitfile,'w') as fh:
+                fh.write(head)
+                spools['taxon'][i].seek(0)
+                shutil.copyfileobj(spools['taxon'][i], fh)
+                fh.write(middle)
+                spools['sequence'][i].seek(0)
+                shutil.copyfileobj(spools['sequence'][i], fh)
+                fh.write(tail)
+    finally:
+        for kind in spools:
+            for spool in spools[kind]:
+                spool.close()
+        shutil.rmtree(spooldir)
+    return [sum(costs[i] for i in chunk) for chunk in chunks]
+
+def write_samples( xmlfile, sizes, outdir, seed=999 ):
+    '''
+    Write a sub-alignment xml of randomly chosen taxa for each size in sizes
+    into outdir
+
+    Returns the list of written paths
+    '''
+    xml = parse_xml(xmlfile)
     idseq = get_all_idtaxa_seqtaxa( xml )
+    remove_children( xml.xpath('alignment')[0] )
+    remove_children( xml.xpath('taxa')[0] )
+    template = etree.tostring(xml)
+    rand = random.Random(seed)
+    paths = []
+    for size in sizes:
+        chosen = sorted(rand.sample(range(len(idseq)), size))
+        path = join(outdir, 'sample_{0}.xml'.format(size))
+        write_split((
+            template,
+            path,
+            [etree.tostring(idseq[i][0]) for i in chosen],
+            [etree.tostring(idseq[i][1]) for i in chosen],
+        ))
+        paths.append( path )
+    return paths
 
-    for i, chunk in enumerate(evenly_split_iterable(idseq, numfiles), start=1):
-        remove_children( xml.xpath('alignment')[0] )
-        remove_children( xml.xpath('taxa' )[0] )
-        for itaxa, staxa in chunk:
-            splitfile = 'split_{0}.xml'.format(i)
-            xml.xpath('taxa')[0].append(itaxa)
-            xml.xpath('alignment')[0].append(staxa)
-            set_dimensions(xml, len(chunk))
-            set_filenames(xml,splitfile)
-            with open(splitfile,'w') as fh:
-                xml.write(fh)
+def fit_runtime_model( points ):
+    '''
+    Least squares fit of hours = fixed + pertaxon * taxa through a list of
+    (taxa, hours) points
+
+    Returns (fixed, pertaxon)
+    '''
+    n = float(len(points))
+    meanx = sum(x for x, y in points) / n
+    meany = sum(y for x, y in points) / n
+    var = sum((x - meanx) ** 2 for x, y in points)
+    if var == 0:
+        raise ValueError( 'Need at least two different sample sizes to fit' )
+    pertaxon = sum((x - meanx) * (y - meany) for x, y in points) / var
+    return meany - pertaxon * meanx, pertaxon
+
+def choose_numfiles( xmlfile, budget, sample_sizes=None, seed=999,
+        stream=sys.stdout, balance='taxa', **beast_options ):
+    '''
+    Pick how many files to split xmlfile into so every split file is
+    predicted to finish within budget hours
+
+    Random sub-alignments of sample_sizes taxa(default about 5% and 10% of
+    the taxa) are run through estimate_beast_runtime with beast_options and
+    a per taxon runtime model is fit to them
+
+    balance - The balance split_xml will be run with(see split_chunks) as
+        it decides how many taxa end up in each file
+
+    Returns (numfiles, predicted hours of each split file)
+    '''
+    idseq = get_all_idtaxa_seqtaxa( parse_xml(xmlfile) )
+    numtaxa = len(idseq)
+    store = AlignmentStore.from_sequences( [staxa for itaxa, staxa in idseq] )
+    costs = store.costs().tolist()
+    if sample_sizes is None:
+        sample_sizes = sorted(set([
+            min(numtaxa, max(2, numtaxa / 20)),
+            min(numtaxa, max(3, numtaxa / 10)),
+        ]))
+
+    tdir = tempfile.mkdtemp(prefix='splitxml', suffix='samples')
+    try:
+        points = []
+        for size, path in zip(sample_sizes, write_samples(xmlfile, sample_sizes, tdir, seed)):
+            hours = estimate_beast_runtime( path, seed, stream, **beast_options )
+            points.append( (size, hours) )
+    finally:
+        shutil.rmtree( tdir )
+    fixed, pertaxon = fit_runtime_model( points )
+
+    if pertaxon <= 0 or fixed + pertaxon * numtaxa <= budget:
+        return 1, [fixed + pertaxon * numtaxa]
+    maxtaxa = int(math.floor((budget - fixed) / pertaxon))
+    if maxtaxa < 1:
+        raise ValueError(
+            'A single taxon is predicted to take longer than {0} hours'.format(budget)
+        )
+
+    numfiles = int(math.ceil(numtaxa / float(maxtaxa)))
+    while True:
+        chunks = split_chunks(
+            range(numtaxa), numfiles, balance, costs, store.rows()
+        )
+        if max(len(chunk) for chunk in chunks) <= maxtaxa:
+            break
+        numfiles += 1
+    return numfiles, [fixed + pertaxon * len(chunk) for chunk in chunks]
+
+def write_run_scripts( splitfiles, option ):
+    '''
+    Write a run_<split>.sh next to each split file that runs beast on it
+    with the beagle options in option
+
+    Returns the script paths
+    '''
+    scripts = []
+    for splitfile in splitfiles:
+        directory, name = os.path.split( splitfile )
+        script = join( directory, 'run_' + splitext(name)[0] + '.sh' )
+        cmd = ['beast'] + option.split() + [name]
+        with open(script, 'w') as fh:
+            fh.write( '#!/bin/sh\n' )
+            fh.write( 'cd "$(dirname "$0")"\n' )
+            fh.write( 'exec {0}\n'.format(' '.join(pipes.quote(a) for a in cmd)) )
+        os.chmod( script, 0755 )
+        scripts.append( script )
+    return scripts
+
+def optimise_splits( splitfiles, costs, stream=sys.stdout, **options ):
+    '''
+    Run the run_beast_options sweep only on the split file with the highest
+    predicted cost, as the splits only differ in their taxa, and write
+    run scripts for every split file with the fastest option
+
+    options are passed on to run_beast_options
+
+    Returns (the fastest BeastRun, the run script paths)
+    Raises ValueError if no option gave an estimate
+    '''
+    representative = splitfiles[costs.index(max(costs))]
+    runs = run_beast_options( representative, stream, **options )
+    best = runs[0]
+    if best[1] == sys.maxint:
+        raise ValueError(
+            'No beagle option gave an estimate for {0}'.format(representative)
+        )
+    return best, write_run_scripts( splitfiles, best[0] )